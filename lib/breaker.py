@@ -0,0 +1,79 @@
+"""Per-asset circuit breaker for connecting to MySQL.
+
+After BREAKER_THRESHOLD consecutive failures to reach the server (timeouts,
+refused or lost connections), checks for the asset fail immediately instead of
+waiting for the connect timeout. A single attempt is allowed after a back-off
+which doubles (with jitter) on every failed attempt; the breaker closes as soon
+as the server is reached, also when it then refuses the credentials.
+"""
+import os
+import random
+import time
+from libprobe.exceptions import CheckException
+from typing import Dict, Optional
+
+
+# Number of consecutive connection failures before the breaker opens
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', 3))
+# Initial and maximum back-off in seconds while the breaker is open
+BREAKER_BACKOFF = float(os.getenv('BREAKER_BACKOFF', 60))
+BREAKER_MAX_BACKOFF = float(os.getenv('BREAKER_MAX_BACKOFF', 1800))
+
+JITTER = 0.2
+
+
+class _Breaker:
+    __slots__ = ('failures', 'retry_at', 'last_error')
+
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = ''
+
+    def backoff(self) -> float:
+        n = self.failures - BREAKER_THRESHOLD
+        backoff = min(BREAKER_BACKOFF * 2 ** n, BREAKER_MAX_BACKOFF)
+        return backoff * random.uniform(1.0 - JITTER, 1.0 + JITTER)
+
+
+_breakers: Dict[int, _Breaker] = {}
+
+
+def breaker_check(asset_id: int, now: Optional[float] = None):
+    """Raise a CheckException when the breaker for the asset is open;
+    otherwise the caller may try to connect."""
+    breaker = _breakers.get(asset_id)
+    if breaker is None or breaker.failures < BREAKER_THRESHOLD:
+        return
+    if now is None:
+        now = time.monotonic()
+    if now < breaker.retry_at:
+        raise CheckException(
+            f'circuit breaker open after {breaker.failures} consecutive '
+            f'connection failures; next attempt in '
+            f'{breaker.retry_at - now:.0f} seconds '
+            f'(last error: {breaker.last_error})')
+    # Half-open; concurrent checks for this asset keep failing fast until
+    # this attempt has finished
+    breaker.retry_at = now + breaker.backoff()
+
+
+def breaker_failure(
+        asset_id: int,
+        error_msg: str,
+        now: Optional[float] = None):
+    breaker = _breakers.get(asset_id)
+    if breaker is None:
+        breaker = _breakers[asset_id] = _Breaker()
+    if now is None:
+        now = time.monotonic()
+    breaker.failures += 1
+    breaker.last_error = error_msg
+    if breaker.failures >= BREAKER_THRESHOLD:
+        breaker.retry_at = now + breaker.backoff()
+
+
+def breaker_success(asset_id: int):
+    # Only assets with failures have an entry, thus memory is bounded by the
+    # number of unreachable assets
+    _breakers.pop(asset_id, None)
@@ -0,0 +1,93 @@
+"""Capabilities of the MySQL server per asset.
+
+The profile is read once and re-used by all checks until the server version
+(sent by the server on every new connection) changes or the server has been
+restarted (uptime went backwards).
+"""
+import re
+from libprobe.asset import Asset
+from typing import Dict, Optional, Tuple
+from .query import query_multi
+
+
+FLAVOUR_MYSQL = 'mysql'
+FLAVOUR_MARIADB = 'mariadb'
+FLAVOUR_PERCONA = 'percona'
+
+QUERY_HAS_INNODB = """\
+SELECT engine
+FROM information_schema.ENGINES
+WHERE engine='InnoDB' and support != 'no' and support != 'disabled'
+"""
+QUERY_CAPABILITY_VARIABLES = """\
+SHOW GLOBAL VARIABLES
+WHERE Variable_name IN (
+    'version', 'version_comment', 'performance_schema', 'innodb_page_size')
+"""
+
+DEFAULT_PAGE_SIZE = 16384
+
+_version = re.compile(r'(\d+)\.(\d+)\.(\d+)')
+
+
+class Capabilities:
+    __slots__ = (
+        'server_info', 'version', 'flavour', 'has_innodb',
+        'has_performance_schema', 'page_size', 'uptime')
+
+    def __init__(self, server_info: str, engines: list, variables: dict):
+        self.server_info = server_info
+        version = variables.get('version', server_info)
+        m = _version.match(version)
+        self.version: Tuple[int, int, int] = \
+            (int(m[1]), int(m[2]), int(m[3])) if m else (0, 0, 0)
+        if 'mariadb' in version.lower():
+            self.flavour = FLAVOUR_MARIADB
+        elif 'percona' in variables.get('version_comment', '').lower():
+            self.flavour = FLAVOUR_PERCONA
+        else:
+            self.flavour = FLAVOUR_MYSQL
+        self.has_innodb = len(engines) > 0
+        self.has_performance_schema = \
+            variables.get('performance_schema') == 'ON'
+        # Before MySQL 5.6 the page size is fixed
+        self.page_size = int(
+            variables.get('innodb_page_size', DEFAULT_PAGE_SIZE))
+        self.uptime = 0
+
+    def __repr__(self) -> str:
+        return (
+            f'<{self.flavour} {".".join(map(str, self.version))} '
+            f'innodb={self.has_innodb} '
+            f'performance_schema={self.has_performance_schema}>')
+
+
+# Capabilities per asset Id
+_capabilities: Dict[int, Capabilities] = {}
+
+
+async def get_capabilities(conn, asset: Asset) -> Capabilities:
+    server_info = conn.get_server_info()
+    caps = _capabilities.get(asset.id)
+    if caps is None or caps.server_info != server_info:
+        res = await query_multi(conn, {
+            'engines': QUERY_HAS_INNODB,
+            'variables': QUERY_CAPABILITY_VARIABLES,
+        })
+        variables = {
+            i['Variable_name']: i['Value'] for i in res['variables']}
+        caps = _capabilities[asset.id] = \
+            Capabilities(server_info, res['engines'], variables)
+    return caps
+
+
+def update_uptime(asset: Asset, uptime: Optional[int]):
+    # The profile is read again on the next run when the server has been
+    # restarted, for example when InnoDB or performance_schema was enabled
+    caps = _capabilities.get(asset.id)
+    if caps is None or uptime is None:
+        return
+    if uptime < caps.uptime:
+        del _capabilities[asset.id]
+    else:
+        caps.uptime = uptime
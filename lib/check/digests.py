@@ -0,0 +1,192 @@
+"""Top statements by digest, from
+performance_schema.events_statements_summary_by_digest
+
+https://dev.mysql.com/doc/refman/8.0/en/performance-schema-statement-summary-tables.html
+
+The summary table holds cumulative values; each run returns the change since
+the previous run for the top digests by time, rows examined and executions.
+Only digests executed since the previous run are read from the server.
+"""
+import heapq
+import os
+import re
+from libprobe.asset import Asset
+from libprobe.exceptions import IgnoreCheckException
+from libprobe.probe import MAX_PACKAGE_SIZE
+from lib.capabilities import get_capabilities
+from lib.query import get_conn, in_list, query, query_stream
+from lib.timing import start_timing
+from typing import Any, Dict, List, Optional, Tuple
+
+
+DEFAULT_TOP_N = 10
+
+# Maximum number of digests per asset for which the previous values are
+# kept; the least recently executed digests are dropped first
+DIGESTS_MAX_STATE = int(os.getenv('DIGESTS_MAX_STATE', 5000))
+# Digest text is truncated to this number of characters
+DIGESTS_MAX_TEXT = int(os.getenv('DIGESTS_MAX_TEXT', 1024))
+
+# Keep the digests well below the maximum package size; the size of an item
+# is estimated as the length of the text plus a fixed size for the values
+MAX_BYTES = MAX_PACKAGE_SIZE // 2
+ITEM_BYTES = 400
+
+QUERY = """\
+SELECT
+    SCHEMA_NAME, DIGEST, COUNT_STAR, SUM_TIMER_WAIT, SUM_ROWS_EXAMINED,
+    SUM_ROWS_SENT, SUM_ERRORS, SUM_NO_INDEX_USED,
+    UNIX_TIMESTAMP(FIRST_SEEN) AS FIRST_SEEN,
+    UNIX_TIMESTAMP(LAST_SEEN) AS LAST_SEEN
+FROM performance_schema.events_statements_summary_by_digest
+WHERE DIGEST IS NOT NULL AND LAST_SEEN >= FROM_UNIXTIME({since})
+"""
+QUERY_TEXT = """\
+SELECT SCHEMA_NAME, DIGEST, LEFT(DIGEST_TEXT, {max_text}) AS DIGEST_TEXT
+FROM performance_schema.events_statements_summary_by_digest
+WHERE DIGEST IN ({digests})
+"""
+
+# Cumulative values in the order of the query
+COUNTERS = (
+    'executions',
+    'time',
+    'rows_examined',
+    'rows_sent',
+    'errors',
+    'no_index_used',
+)
+# Top lists, by the index in COUNTERS of the value to rank on
+TOP_BY = (
+    COUNTERS.index('time'),
+    COUNTERS.index('rows_examined'),
+    COUNTERS.index('executions'),
+)
+
+_is_digest = re.compile(r'^[0-9a-f]+$').match
+
+Key = Tuple[Optional[str], str]
+Values = Tuple[int, ...]
+
+
+class _DigestState:
+    __slots__ = ('since', 'digests')
+
+    def __init__(self):
+        # Server timestamp of the most recent execution seen
+        self.since = 0.0
+        # Values by (schema, digest); ordered from least to most recently
+        # executed
+        self.digests: Dict[Key, Values] = {}
+
+
+# Previous values per asset Id
+_state: Dict[int, _DigestState] = {}
+
+
+def _delta(
+        state: _DigestState,
+        key: Key,
+        values: Values,
+        first_seen: float) -> Optional[Values]:
+    prev = state.digests.pop(key, None)
+    state.digests[key] = values
+    # First seen after the previous run: a new digest, or the summary table
+    # was truncated or the server has been restarted since (the counters may
+    # have grown past the previous values already)
+    is_new = bool(state.since) and first_seen > state.since
+    if prev is None:
+        # Unknown digest; only returned when new
+        return values if is_new else None
+    if is_new or values[0] < prev[0]:
+        return values
+    return tuple(cur - old for cur, old in zip(values, prev))
+
+
+def _item(key: Key, delta: Values, text: Optional[str]) -> Dict[str, Any]:
+    schema, digest = key
+    item: Dict[str, Any] = dict(zip(COUNTERS, delta))
+    item['name'] = f'{schema or ""}:{digest}'
+    item['schema'] = schema
+    item['digest'] = digest
+    item['digest_text'] = text
+    # Timer values are in picoseconds
+    item['time'] = delta[1] / 1e12
+    item['avg_time'] = item['time'] / delta[0]
+    return item
+
+
+async def check_digests(
+        asset: Asset,
+        asset_config: dict,
+        config: dict) -> dict:
+
+    timing = start_timing()
+    top_n = int(config.get('top_n', DEFAULT_TOP_N))
+    state = _state.get(asset.id)
+    if state is None:
+        state = _state[asset.id] = _DigestState()
+    is_first = not state.since
+
+    # One bounded heap per top list, with (value, counter, key, delta); the
+    # counter prevents comparing keys for equal values
+    heaps: List[List[tuple]] = [[] for _ in TOP_BY]
+    n, since = 0, state.since
+    async with get_conn(asset, asset_config, config) as conn:
+        caps = await get_capabilities(conn, asset)
+        if not caps.has_performance_schema:
+            raise IgnoreCheckException
+
+        async for rows in query_stream(
+                conn, QUERY.format(since=state.since), as_records=True):
+            for row in rows:
+                key = (row.SCHEMA_NAME, row.DIGEST)
+                values = tuple(int(v or 0) for v in row[2:8])
+                delta = _delta(state, key, values, row.FIRST_SEEN or 0.0)
+                since = max(since, row.LAST_SEEN or 0.0)
+                if delta is None or delta[0] <= 0:
+                    continue
+                n += 1
+                for heap, idx in zip(heaps, TOP_BY):
+                    entry = (delta[idx], n, key, delta)
+                    if len(heap) < top_n:
+                        heapq.heappush(heap, entry)
+                    elif entry > heap[0]:
+                        heapq.heapreplace(heap, entry)
+
+        top: Dict[Key, Values] = {}
+        for heap in heaps:
+            for _, _, key, delta in heapq.nlargest(top_n, heap):
+                top.setdefault(key, delta)
+
+        texts: Dict[Key, str] = {}
+        digests = {digest for _, digest in top if _is_digest(digest)}
+        if digests:
+            for row in await query(conn, QUERY_TEXT.format(
+                    max_text=DIGESTS_MAX_TEXT,
+                    digests=in_list(digests)), as_records=True):
+                texts[(row.SCHEMA_NAME, row.DIGEST)] = row.DIGEST_TEXT
+
+    state.since = since
+    while len(state.digests) > DIGESTS_MAX_STATE:
+        del state.digests[next(iter(state.digests))]
+
+    items = []
+    size = 0
+    for key, delta in top.items():
+        text = texts.get(key)
+        size += ITEM_BYTES + len(text or '')
+        if size > MAX_BYTES:
+            break
+        items.append(_item(key, delta, text))
+
+    item_probe = timing.as_item()
+    item_probe['name'] = 'digests'
+    item_probe['digests_changed'] = n
+    item_probe['digests_state'] = len(state.digests)
+    item_probe['first_run'] = is_first
+
+    return {
+        'digests': items,
+        'probe': [item_probe],
+    }
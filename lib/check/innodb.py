@@ -1,322 +1,733 @@
+import functools
 import logging
+import os
 import re
 from collections import defaultdict
 from libprobe.asset import Asset
 from libprobe.exceptions import IgnoreCheckException
-from lib.query import get_conn, query
-from typing import Dict, Any
+from lib.capabilities import FLAVOUR_MARIADB, Capabilities, \
+    get_capabilities, update_uptime
+from lib.counters import CounterStore
+from lib.executor import run_parser
+from lib.load import TIER_LIGHT, load_tier, record_load
+from lib.payload import PAYLOAD_DELTA, PAYLOAD_FULL, compact_result
+from lib.query import UnavailableError, get_conn, in_list, query_multi
+from lib.scheduler import parses
+from lib.timing import CheckTiming, start_timing
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple
 
 
-QUERY_HAS_INNODB = """\
-SELECT engine
-FROM information_schema.ENGINES
-WHERE engine='InnoDB' and support != 'no' and support != 'disabled'
-"""
 QUERY = "SHOW /*!50000 ENGINE*/ INNODB STATUS"
 
+SOURCE_STATUS = 'status'
+SOURCE_METRICS = 'metrics'
 
-def get_stats_from_innodb_status(innodb_status_text) -> Dict[str, Any]:
-    results: Dict[str, Any] = defaultdict(int)
+# Only the first INNODB_MAX_TRANSACTIONS transactions are fully parsed; For
+# the others only the transactions, lock waits, lock structs and tables in
+# use are counted (0 = no limit)
+INNODB_MAX_TRANSACTIONS = int(os.getenv('INNODB_MAX_TRANSACTIONS', 1000))
 
-    # Here we now parse InnoDB STATUS one line at a time
-    # This is heavily inspired by the Percona monitoring plugins work
-    txn_seen = False
-    prev_line = ''
-    # Only return aggregated buffer pool metrics
-    buffer_id = -1
-    for line in innodb_status_text.splitlines():
-        line = line.strip()
-        row = re.split(" +", line)
-        row = [item.strip(',') for item in row]
-        row = [item.strip(';') for item in row]
-        row = [item.strip('[') for item in row]
-        row = [item.strip(']') for item in row]
+# Section headers which may follow the TRANSACTIONS section
+_SECTIONS_AFTER_TRANSACTIONS = frozenset((
+    'FILE I/O',
+    'INSERT BUFFER AND ADAPTIVE HASH INDEX',
+    'LOG',
+    'BUFFER POOL AND MEMORY',
+    'INDIVIDUAL BUFFER POOL INFO',
+    'ROW OPERATIONS',
+    'END OF INNODB MONITOR OUTPUT',
+))
 
-        if line.startswith('---BUFFER POOL'):
-            buffer_id = int(row[2])
-
-        # SEMAPHORES
-        if line.find('Mutex spin waits') == 0:
-            # Mutex spin waits 79626940, rounds 157459864, OS waits 698719
-            # Mutex spin waits 0, rounds 247280272495, OS waits 316513438
-            results['mutex_spin_waits'] = int(row[3])
-            results['mutex_spin_rounds'] = int(row[5])
-            results['mutex_os_waits'] = int(row[8])
-        elif line.find('RW-shared spins') == 0 and line.find(';') > 0:
-            # RW-shared spins 3859028, OS waits 2100750; RW-excl spins
-            # 4641946, OS waits 1530310
-            results['s_lock_spin_waits'] = int(row[2])
-            results['x_lock_spin_waits'] = int(row[8])
-            results['s_lock_os_waits'] = int(row[5])
-            results['x_lock_os_waits'] = int(row[11])
-        elif line.find('RW-shared spins') == 0 and \
-                line.find('; RW-excl spins') == -1:
-            # Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
-            # RW-shared spins 604733, rounds 8107431, OS waits 241268
-            results['s_lock_spin_waits'] = int(row[2])
-            results['s_lock_spin_rounds'] = int(row[4])
-            results['s_lock_os_waits'] = int(row[7])
-        elif line.find('RW-excl spins') == 0:
-            # Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
-            # RW-excl spins 604733, rounds 8107431, OS waits 241268
-            results['x_lock_spin_waits'] = int(row[2])
-            results['x_lock_spin_rounds'] = int(row[4])
-            results['x_lock_os_waits'] = int(row[7])
-        elif line.find('seconds the semaphore:') > 0:
-            # --Thread 907205 has waited at handler/ha_innodb.cc line 7156 for
-            # 1.00 seconds the semaphore:
-            results['semaphore_waits'] += 1
-            results['semaphore_wait_time'] += int(float(row[9])) * 1000
-
-        # TRANSACTIONS
-        elif line.find('Trx id counter') == 0:
-            # The beginning of the TRANSACTIONS section: start counting
-            # transactions
-            # Trx id counter 0 1170664159
-            # Trx id counter 861B144C
-            txn_seen = True
-        elif line.find('History list length') == 0:
-            # History list length 132
-            results['history_list_length'] = int(row[3])
-        elif txn_seen and line.find('---TRANSACTION') == 0:
-            # ---TRANSACTION 0, not started, process no 13510, OS thread id
-            # 1170446656
-            results['current_transactions'] += 1
-            if line.find('ACTIVE') > 0:
-                results['active_transactions'] += 1
-        elif line.find('read views open inside InnoDB') > 0:
-            # 1 read views open inside InnoDB
-            results['read_views'] = int(row[0])
-        elif line.find('mysql tables in use') == 0:
-            # mysql tables in use 2, locked 2
-            results['tables_in_use'] += int(row[4])
-            results['locked_tables'] += int(row[6])
-        elif txn_seen and line.find('lock struct(s)') > 0:
-            # 23 lock struct(s), heap size 3024, undo log entries 27
-            # LOCK WAIT 12 lock struct(s), heap size 3024, undo log entries 5
-            # LOCK WAIT 2 lock struct(s), heap size 368
-            if line.find('LOCK WAIT') == 0:
-                results['lock_structs'] += int(row[2])
-                results['locked_transactions'] += 1
-            elif line.find('ROLLING BACK') == 0:
-                # ROLLING BACK 127539 lock struct(s), heap size 15201832,
-                # 4411492 row lock(s), undo log entries 1042488
-                results['lock_structs'] += int(row[2])
-            else:
-                results['lock_structs'] += int(row[0])
-
-        # FILE I/O
-        elif line.find(' OS file reads, ') > 0:
-            # 8782182 OS file reads, 15635445 OS file writes, 947800 OS
-            # fsyncs
-            results['os_file_reads'] = int(row[0])
-            results['os_file_writes'] = int(row[4])
-            results['os_file_fsyncs'] = int(row[8])
-        elif line.find('Pending normal aio reads:') == 0:
-            try:
-                if len(row) == 8:
-                    # (len(row) == 8)  Pending normal aio reads: 0, aio
-                    # writes: 0,
-                    results['pending_normal_aio_reads'] = int(row[4])
-                    results['pending_normal_aio_writes'] = int(row[7])
-                elif len(row) == 14:
-                    # (len(row) == 14) Pending normal aio reads: 0 [0, 0] ,
-                    # aio writes: 0 [0, 0] ,
-                    results['pending_normal_aio_reads'] = int(row[4])
-                    results['pending_normal_aio_writes'] = int(row[10])
-                elif len(row) == 16:
-                    # (len(row) == 16) Pending normal aio reads:
-                    # [0, 0, 0, 0] , aio writes: [0, 0, 0, 0] ,
-                    if all(v.isdigit() for v in row[4:8]) and \
-                            all(v.isdigit() for v in row[11:15]):
-                        results['pending_normal_aio_reads'] = sum(
-                            map(int, (row[4], row[5], row[6], row[7]))
-                        )
-                        results['pending_normal_aio_writes'] = sum(
-                            map(int, (row[11], row[12], row[13], row[14]))
-                        )
-
-                    # (len(row) == 16) Pending normal aio reads: 0
-                    # [0, 0, 0, 0] , aio writes: 0 [0, 0] ,
-                    elif all(v.isdigit() for v in row[4:9]) and \
-                            all(v.isdigit() for v in row[12:15]):
-                        results['pending_normal_aio_reads'] = int(row[4])
-                        results['pending_normal_aio_writes'] = int(row[12])
-                    else:
-                        logging.warning(f"Can't parse result line {line}")
-                elif len(row) == 18:
-                    # (len(row) == 18) Pending normal aio reads: 0
-                    # [0, 0, 0, 0] , aio writes: 0 [0, 0, 0, 0] ,
-                    results['pending_normal_aio_reads'] = int(row[4])
-                    results['pending_normal_aio_writes'] = int(row[12])
-                elif len(row) == 22:
-                    # (len(row) == 22)
-                    # Pending normal aio reads: 0 [0, 0, 0, 0, 0, 0, 0, 0] ,
-                    # aio writes: 0 [0, 0, 0, 0] ,
-                    results['pending_normal_aio_reads'] = int(row[4])
-                    results['pending_normal_aio_writes'] = int(row[16])
-            except ValueError as e:
-                logging.warning(f"Can't parse result line {line}: {e}")
-        elif line.find('ibuf aio reads') == 0:
-            #  ibuf aio reads: 0, log i/o's: 0, sync i/o's: 0
-            #  or ibuf aio reads:, log i/o's:, sync i/o's:
-            if len(row) == 10:
-                results['pending_ibuf_aio_reads'] = int(row[3])
-                results['pending_aio_log_ios'] = int(row[6])
-                results['pending_aio_sync_ios'] = int(row[9])
-            elif len(row) == 7:
-                results['pending_ibuf_aio_reads'] = 0
-                results['pending_aio_log_ios'] = 0
-                results['pending_aio_sync_ios'] = 0
-        elif line.find('Pending flushes (fsync)') == 0:
-            if len(row) == 4:
-                # Pending flushes (fsync): 0
-                results['pending_buffer_pool_flushes'] = int(row[3])
+# Global status variables for the `metrics` source and the `innodb` item key
+# they map to; Only variables which count the same as the InnoDB status are
+# mapped. Not mapped are Innodb_log_writes (log write requests, not the log
+# i/o's done), Innodb_data_pending_fsyncs (log and tablespace fsyncs, not the
+# buffer pool flushes) and Innodb_data_pending_reads/writes (all pending file
+# I/O, not the normal aio slots)
+INNODB_STATUS_VARS = {
+    'Innodb_page_size': 'page_size',
+    'Innodb_buffer_pool_pages_total': 'buffer_pool_pages_total',
+    'Innodb_buffer_pool_pages_free': 'buffer_pool_pages_free',
+    'Innodb_buffer_pool_pages_data': 'buffer_pool_pages_data',
+    'Innodb_buffer_pool_pages_dirty': 'buffer_pool_pages_dirty',
+    'Innodb_buffer_pool_bytes_data': 'buffer_pool_bytes_data',
+    'Innodb_buffer_pool_bytes_dirty': 'buffer_pool_bytes_dirty',
+    'Innodb_pages_read': 'pages_read',
+    'Innodb_pages_created': 'pages_created',
+    'Innodb_pages_written': 'pages_written',
+    'Innodb_rows_inserted': 'rows_inserted',
+    'Innodb_rows_updated': 'rows_updated',
+    'Innodb_rows_deleted': 'rows_deleted',
+    'Innodb_rows_read': 'rows_read',
+    'Innodb_data_reads': 'os_file_reads',
+    'Innodb_data_writes': 'os_file_writes',
+    'Innodb_data_fsyncs': 'os_file_fsyncs',
+    'Innodb_os_log_pending_fsyncs': 'pending_log_flushes',
+    'Innodb_os_log_pending_writes': 'pending_log_writes',
+    'Innodb_row_lock_current_waits': 'locked_transactions',
+    # MariaDB and Percona Server only
+    'Innodb_history_list_length': 'history_list_length',
+    'Innodb_lsn_current': 'lsn_current',
+    'Innodb_lsn_flushed': 'lsn_flushed',
+    'Innodb_lsn_last_checkpoint': 'lsn_last_checkpoint',
+    'Innodb_ibuf_size': 'ibuf_size',
+    'Innodb_ibuf_free_list': 'ibuf_free_list',
+    'Innodb_ibuf_segment_size': 'ibuf_segment_size',
+    'Innodb_ibuf_merges': 'ibuf_merges',
+    'Innodb_ibuf_merged_inserts': 'ibuf_merged_inserts',
+    'Innodb_ibuf_merged_delete_marks': 'ibuf_merged_delete_marks',
+    'Innodb_ibuf_merged_deletes': 'ibuf_merged_deletes',
+    'Innodb_mutex_spin_waits': 'mutex_spin_waits',
+    'Innodb_mutex_spin_rounds': 'mutex_spin_rounds',
+    'Innodb_mutex_os_waits': 'mutex_os_waits',
+    'Innodb_s_lock_spin_waits': 's_lock_spin_waits',
+    'Innodb_s_lock_spin_rounds': 's_lock_spin_rounds',
+    'Innodb_s_lock_os_waits': 's_lock_os_waits',
+    'Innodb_x_lock_spin_waits': 'x_lock_spin_waits',
+    'Innodb_x_lock_spin_rounds': 'x_lock_spin_rounds',
+    'Innodb_x_lock_os_waits': 'x_lock_os_waits',
+    'Innodb_mem_total': 'mem_total',
+    'Innodb_mem_adaptive_hash': 'mem_adaptive_hash',
+    'Innodb_mem_dictionary': 'mem_dictionary',
+}
+
+# INNODB_METRICS counters for the `metrics` source; Only used for keys which
+# are not found in the global status
+INNODB_METRICS_VARS = {
+    'trx_rseg_history_len': 'history_list_length',
+    'log_lsn_current': 'lsn_current',
+    'log_lsn_last_flush': 'lsn_flushed',
+    'log_lsn_last_checkpoint': 'lsn_last_checkpoint',
+    'log_pending_checkpoint_writes': 'pending_checkpoint_writes',
+    'ibuf_size': 'ibuf_size',
+    'ibuf_merges': 'ibuf_merges',
+    'ibuf_merges_insert': 'ibuf_merged_inserts',
+    'ibuf_merges_delete_mark': 'ibuf_merged_delete_marks',
+    'ibuf_merges_delete': 'ibuf_merged_deletes',
+    'innodb_rwlock_s_spin_waits': 's_lock_spin_waits',
+    'innodb_rwlock_s_spin_rounds': 's_lock_spin_rounds',
+    'innodb_rwlock_s_os_waits': 's_lock_os_waits',
+    'innodb_rwlock_x_spin_waits': 'x_lock_spin_waits',
+    'innodb_rwlock_x_spin_rounds': 'x_lock_spin_rounds',
+    'innodb_rwlock_x_os_waits': 'x_lock_os_waits',
+}
+
+
+QUERY_INNODB_STATUS_VARS = f"""\
+SHOW GLOBAL STATUS
+WHERE Variable_name IN ({in_list(INNODB_STATUS_VARS)})
+"""
+QUERY_INNODB_METRICS = f"""\
+SELECT NAME, COUNT
+FROM information_schema.INNODB_METRICS
+WHERE STATUS = 'enabled' AND NAME IN ({in_list(INNODB_METRICS_VARS)})
+"""
+
+QUERY_UPTIME = "SHOW GLOBAL STATUS LIKE 'Uptime'"
+
+# Monotonic counters in the `innodb` item; For each of these counters a
+# per-second rate is added as `<key>_rate`
+INNODB_COUNTERS = (
+    'mutex_spin_waits',
+    'mutex_spin_rounds',
+    'mutex_os_waits',
+    's_lock_spin_waits',
+    's_lock_spin_rounds',
+    's_lock_os_waits',
+    'x_lock_spin_waits',
+    'x_lock_spin_rounds',
+    'x_lock_os_waits',
+    'os_file_reads',
+    'os_file_writes',
+    'os_file_fsyncs',
+    'ibuf_merges',
+    'ibuf_merged',
+    'ibuf_merged_inserts',
+    'ibuf_merged_delete_marks',
+    'ibuf_merged_deletes',
+    'log_writes',
+    'pages_read',
+    'pages_created',
+    'pages_written',
+    'rows_inserted',
+    'rows_updated',
+    'rows_deleted',
+    'rows_read',
+)
+
+# Monotonic counters in the `innodb_buffer_pool` items
+BUFFER_POOL_COUNTERS = (
+    'pages_read',
+    'pages_created',
+    'pages_written',
+)
+
+# Capabilities of the server per asset Id for which the `metrics` source is
+# not available; The source is tried again when the capabilities change (an
+# upgrade or a restart)
+_no_metrics_source: Dict[int, Capabilities] = {}
+# Previous counter values per asset Id, per source; The sources do not count
+# exactly the same, thus a rate is only computed between samples of the same
+# source (the light tier may switch sources between runs)
+_innodb_counters = {
+    SOURCE_STATUS: CounterStore(INNODB_COUNTERS),
+    SOURCE_METRICS: CounterStore(INNODB_COUNTERS),
+}
+# Previous counter values per buffer pool instance, per asset Id
+_buffer_pool_counters: Dict[str, CounterStore] = {}
+
+_split = re.compile(' +').split
+
+
+def iter_lines(text: str, chunk_size: int = 65536) -> Iterator[str]:
+    # Same as iter(text.splitlines()) but only a chunk of the text is split
+    # at a time, so memory stays bounded for large texts
+    pos, end = 0, len(text)
+    while pos < end:
+        nxt = text.find('\n', pos + chunk_size)
+        if nxt == -1:
+            nxt = end
+        yield from text[pos:nxt + 1].splitlines()
+        pos = nxt + 1
+
+
+def _tokenize(line: str) -> List[str]:
+    return [
+        item.strip(',').strip(';').strip('[').strip(']')
+        for item in _split(line)]
+
+
+class _ParserState:
+    __slots__ = (
+        'txn_seen', 'prev_line', 'buffer_id', 'buffer_pools', 'buffer_pool',
+        'skip_transactions')
+
+    def __init__(self, buffer_pools: bool = False):
+        self.txn_seen = False
+        self.prev_line = ''
+        # Id of the buffer pool instance (-1 for the aggregated metrics)
+        self.buffer_id = -1
+        # Metrics per buffer pool instance, only when requested, and the
+        # metrics of the current instance
+        self.buffer_pools: Optional[List[Dict[str, Any]]] = \
+            [] if buffer_pools else None
+        self.buffer_pool: Optional[Dict[str, Any]] = None
+        # Set when INNODB_MAX_TRANSACTIONS is reached
+        self.skip_transactions = False
+
+
+Results = Dict[str, Any]
+Handler = Callable[[Results, List[str], str, _ParserState], None]
+Condition = Callable[[str, _ParserState], bool]
+
+
+# SEMAPHORES
+
+def _mutex_spin_waits(results: Results, row: List[str], line: str,
+                      state: _ParserState):
+    # Mutex spin waits 79626940, rounds 157459864, OS waits 698719
+    # Mutex spin waits 0, rounds 247280272495, OS waits 316513438
+    results['mutex_spin_waits'] = int(row[3])
+    results['mutex_spin_rounds'] = int(row[5])
+    results['mutex_os_waits'] = int(row[8])
+
+
+def _rw_spins(results: Results, row: List[str], line: str,
+              state: _ParserState):
+    # RW-shared spins 3859028, OS waits 2100750; RW-excl spins
+    # 4641946, OS waits 1530310
+    results['s_lock_spin_waits'] = int(row[2])
+    results['x_lock_spin_waits'] = int(row[8])
+    results['s_lock_os_waits'] = int(row[5])
+    results['x_lock_os_waits'] = int(row[11])
+
+
+def _rw_shared_spins(results: Results, row: List[str], line: str,
+                     state: _ParserState):
+    # Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
+    # RW-shared spins 604733, rounds 8107431, OS waits 241268
+    results['s_lock_spin_waits'] = int(row[2])
+    results['s_lock_spin_rounds'] = int(row[4])
+    results['s_lock_os_waits'] = int(row[7])
+
+
+def _rw_excl_spins(results: Results, row: List[str], line: str,
+                   state: _ParserState):
+    # Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
+    # RW-excl spins 604733, rounds 8107431, OS waits 241268
+    results['x_lock_spin_waits'] = int(row[2])
+    results['x_lock_spin_rounds'] = int(row[4])
+    results['x_lock_os_waits'] = int(row[7])
+
+
+def _semaphore_wait(results: Results, row: List[str], line: str,
+                    state: _ParserState):
+    # --Thread 907205 has waited at handler/ha_innodb.cc line 7156 for
+    # 1.00 seconds the semaphore:
+    results['semaphore_waits'] += 1
+    results['semaphore_wait_time'] += int(float(row[9])) * 1000
+
+
+# TRANSACTIONS
+
+def _trx_id_counter(results: Results, row: List[str], line: str,
+                    state: _ParserState):
+    # The beginning of the TRANSACTIONS section: start counting
+    # transactions
+    # Trx id counter 0 1170664159
+    # Trx id counter 861B144C
+    state.txn_seen = True
+
+
+def _history_list_length(results: Results, row: List[str], line: str,
+                         state: _ParserState):
+    # History list length 132
+    results['history_list_length'] = int(row[3])
+
+
+def _transaction(results: Results, row: List[str], line: str,
+                 state: _ParserState):
+    # ---TRANSACTION 0, not started, process no 13510, OS thread id
+    # 1170446656
+    results['current_transactions'] += 1
+    if line.find('ACTIVE') > 0:
+        results['active_transactions'] += 1
+    if INNODB_MAX_TRANSACTIONS and \
+            results['current_transactions'] == INNODB_MAX_TRANSACTIONS + 1:
+        state.skip_transactions = True
+
+
+def _read_views(results: Results, row: List[str], line: str,
+                state: _ParserState):
+    # 1 read views open inside InnoDB
+    results['read_views'] = int(row[0])
+
+
+def _tables_in_use(results: Results, row: List[str], line: str,
+                   state: _ParserState):
+    # mysql tables in use 2, locked 2
+    results['tables_in_use'] += int(row[4])
+    results['locked_tables'] += int(row[6])
+
+
+def _lock_structs(results: Results, row: List[str], line: str,
+                  state: _ParserState):
+    # 23 lock struct(s), heap size 3024, undo log entries 27
+    # LOCK WAIT 12 lock struct(s), heap size 3024, undo log entries 5
+    # LOCK WAIT 2 lock struct(s), heap size 368
+    if line.find('LOCK WAIT') == 0:
+        results['lock_structs'] += int(row[2])
+        results['locked_transactions'] += 1
+    elif line.find('ROLLING BACK') == 0:
+        # ROLLING BACK 127539 lock struct(s), heap size 15201832,
+        # 4411492 row lock(s), undo log entries 1042488
+        results['lock_structs'] += int(row[2])
+    else:
+        results['lock_structs'] += int(row[0])
+
+
+# FILE I/O
+
+def _os_file_reads(results: Results, row: List[str], line: str,
+                   state: _ParserState):
+    # 8782182 OS file reads, 15635445 OS file writes, 947800 OS
+    # fsyncs
+    results['os_file_reads'] = int(row[0])
+    results['os_file_writes'] = int(row[4])
+    results['os_file_fsyncs'] = int(row[8])
+
+
+def _pending_normal_aio(results: Results, row: List[str], line: str,
+                        state: _ParserState):
+    try:
+        if len(row) == 8:
+            # (len(row) == 8)  Pending normal aio reads: 0, aio
+            # writes: 0,
+            results['pending_normal_aio_reads'] = int(row[4])
+            results['pending_normal_aio_writes'] = int(row[7])
+        elif len(row) == 14:
+            # (len(row) == 14) Pending normal aio reads: 0 [0, 0] ,
+            # aio writes: 0 [0, 0] ,
+            results['pending_normal_aio_reads'] = int(row[4])
+            results['pending_normal_aio_writes'] = int(row[10])
+        elif len(row) == 16:
+            # (len(row) == 16) Pending normal aio reads:
+            # [0, 0, 0, 0] , aio writes: [0, 0, 0, 0] ,
+            if all(v.isdigit() for v in row[4:8]) and \
+                    all(v.isdigit() for v in row[11:15]):
+                results['pending_normal_aio_reads'] = sum(
+                    map(int, (row[4], row[5], row[6], row[7]))
+                )
+                results['pending_normal_aio_writes'] = sum(
+                    map(int, (row[11], row[12], row[13], row[14]))
+                )
+
+            # (len(row) == 16) Pending normal aio reads: 0
+            # [0, 0, 0, 0] , aio writes: 0 [0, 0] ,
+            elif all(v.isdigit() for v in row[4:9]) and \
+                    all(v.isdigit() for v in row[12:15]):
+                results['pending_normal_aio_reads'] = int(row[4])
+                results['pending_normal_aio_writes'] = int(row[12])
             else:
-                # Pending flushes (fsync) log: 0; buffer pool: 0
-                results['pending_log_flushes'] = int(row[4])
-                results['pending_buffer_pool_flushes'] = int(row[7])
-
-        # INSERT BUFFER AND ADAPTIVE HASH INDEX
-        elif line.find('Ibuf for space 0: size ') == 0:
-            # Older InnoDB code seemed to be ready for an ibuf per tablespace.
-            # It had two lines in the output.  Newer has just one line, see
-            # below.
-            # Ibuf for space 0: size 1, free list len 887, seg size 889, is
-            # not empty
-            # Ibuf for space 0: size 1, free list len 887, seg size 889,
-            results['ibuf_size'] = int(row[5])
-            results['ibuf_free_list'] = int(row[9])
-            results['ibuf_segment_size'] = int(row[12])
-        elif line.find('Ibuf: size ') == 0:
-            # Ibuf: size 1, free list len 4634, seg size 4636,
-            results['ibuf_size'] = int(row[2])
-            results['ibuf_free_list'] = int(row[6])
-            results['ibuf_segment_size'] = int(row[9])
-
-            if line.find('merges') > -1:
-                results['ibuf_merges'] = int(row[10])
-        elif line.find(', delete mark ') > 0 and \
-                prev_line.find('merged operations:') == 0:
-            # Output of show engine innodb status has changed in 5.5
-            # merged operations:
-            # insert 593983, delete mark 387006, delete 73092
-            results['ibuf_merged_inserts'] = int(row[1])
-            results['ibuf_merged_delete_marks'] = int(row[4])
-            results['ibuf_merged_deletes'] = int(row[6])
-            results['ibuf_merged'] = sum(
-                map(int, [row[1], row[4], row[6]]))
-        elif line.find(' merged recs, ') > 0:
-            # 19817685 inserts, 19817684 merged recs, 3552620 merges
-            results['ibuf_merged_inserts'] = int(row[0])
-            results['ibuf_merged'] = int(row[2])
-            results['ibuf_merges'] = int(row[5])
-        elif line.find('Hash table size ') == 0:
-            # In some versions of InnoDB, the used cells is omitted.
-            # Hash table size 4425293, used cells 4229064, ....
-            # Hash table size 57374437, node heap has 72964 buffer(s) <--
-            # no used cells
-            results['hash_index_cells_total'] = int(row[3])
-            results['hash_index_cells_used'] = int(row[6]) \
-                if line.find('used cells') > 0 else 0
-
-        # LOG
-        elif line.find(" log i/o's done, ") > 0:
-            # 3430041 log i/o's done, 17.44 log i/o's/second
-            # 520835887 log i/o's done, 17.28 log i/o's/second, 518724686
-            # syncs, 2980893 checkpoints
-            results['log_writes'] = int(row[0])
-        elif line.find(" pending log writes, ") > 0:
-            # 0 pending log writes, 0 pending chkp writes
-            results['pending_log_writes'] = int(row[0])
-            results['pending_checkpoint_writes'] = int(row[4])
-        elif line.find("Log sequence number") == 0:
-            # This number is NOT printed in hex in InnoDB plugin.
-            # Log sequence number 272588624
-            results['lsn_current'] = int(row[3])
-        elif line.find("Log flushed up to") == 0:
-            # This number is NOT printed in hex in InnoDB plugin.
-            # Log flushed up to   272588624
-            results['lsn_flushed'] = int(row[4])
-        elif line.find("Last checkpoint at") == 0:
-            # Last checkpoint at  272588624
-            results['lsn_last_checkpoint'] = int(row[3])
-
-        # BUFFER POOL AND MEMORY
-        elif line.find("Total memory allocated") == 0 and \
-                line.find("in additional pool allocated") > 0:
-            # Total memory allocated 29642194944; in additional pool
-            # allocated 0
-            # Total memory allocated by read views 96
-            results['mem_total'] = int(row[3])
-            results['mem_additional_pool'] = int(row[8])
-        elif line.find('Adaptive hash index ') == 0:
-            #   Adaptive hash index 1538240664     (186998824 + 1351241840)
-            results['mem_adaptive_hash'] = int(row[3])
-        elif line.find('Page hash           ') == 0:
-            #   Page hash           11688584
-            results['mem_page_hash'] = int(row[2])
-        elif line.find('Dictionary cache    ') == 0:
-            #   Dictionary cache    145525560      (140250984 + 5274576)
-            results['mem_dictionary'] = int(row[2])
-        elif line.find('File system         ') == 0:
-            #   File system         313848         (82672 + 231176)
-            results['mem_file_system'] = int(row[2])
-        elif line.find('Lock system         ') == 0:
-            #   Lock system         29232616       (29219368 + 13248)
-            results['mem_lock_system'] = int(row[2])
-        elif line.find('Recovery system     ') == 0:
-            #   Recovery system     0      (0 + 0)
-            results['mem_recovery_system'] = int(row[2])
-        elif line.find('Threads             ') == 0:
-            #   Threads             409336         (406936 + 2400)
-            results['mem_thread_hash'] = int(row[1])
-        elif line.find("Buffer pool size ") == 0:
-            # The " " after size is necessary to avoid matching the wrong line:
-            # Buffer pool size        1769471
-            # Buffer pool size, bytes 28991012864
-            if buffer_id == -1:
-                results['buffer_pool_pages_total'] = int(row[3])
-        elif line.find("Free buffers") == 0:
-            # Free buffers            0
-            if buffer_id == -1:
-                results['buffer_pool_pages_free'] = int(row[2])
-        elif line.find("Database pages") == 0:
-            # Database pages          1696503
-            if buffer_id == -1:
-                results['buffer_pool_pages_data'] = int(row[2])
-
-        elif line.find("Modified db pages") == 0:
-            # Modified db pages       160602
-            if buffer_id == -1:
-                results['buffer_pool_pages_dirty'] = int(row[3])
-        elif line.find("Pages read ahead") == 0:
-            # Must do this BEFORE the next test, otherwise it'll get fooled by
-            # this line from the new plugin:
-            # Pages read ahead 0.00/s, evicted without access 0.06/s
-            pass
-        elif line.find("Pages read") == 0:
-            # Pages read 15240822, created 1770238, written 21705836
-            if buffer_id == -1:
-                results['pages_read'] = int(row[2])
-                results['pages_created'] = int(row[4])
-                results['pages_written'] = int(row[6])
-
-        # ROW OPERATIONS
-        elif line.find('Number of rows inserted') == 0:
-            # Number of rows inserted 50678311, updated 66425915, deleted
-            # 20605903, read 454561562
-            results['rows_inserted'] = int(row[4])
-            results['rows_updated'] = int(row[6])
-            results['rows_deleted'] = int(row[8])
-            results['rows_read'] = int(row[10])
-        elif line.find(" queries inside InnoDB, ") > 0:
-            # 0 queries inside InnoDB, 0 queries in queue
-            results['queries_inside'] = int(row[0])
-            results['queries_queued'] = int(row[4])
-
-        prev_line = line
+                logging.warning(f"Can't parse result line {line}")
+        elif len(row) == 18:
+            # (len(row) == 18) Pending normal aio reads: 0
+            # [0, 0, 0, 0] , aio writes: 0 [0, 0, 0, 0] ,
+            results['pending_normal_aio_reads'] = int(row[4])
+            results['pending_normal_aio_writes'] = int(row[12])
+        elif len(row) == 22:
+            # (len(row) == 22)
+            # Pending normal aio reads: 0 [0, 0, 0, 0, 0, 0, 0, 0] ,
+            # aio writes: 0 [0, 0, 0, 0] ,
+            results['pending_normal_aio_reads'] = int(row[4])
+            results['pending_normal_aio_writes'] = int(row[16])
+    except ValueError as e:
+        logging.warning(f"Can't parse result line {line}: {e}")
+
+
+def _ibuf_aio_reads(results: Results, row: List[str], line: str,
+                    state: _ParserState):
+    #  ibuf aio reads: 0, log i/o's: 0, sync i/o's: 0
+    #  or ibuf aio reads:, log i/o's:, sync i/o's:
+    if len(row) == 10:
+        results['pending_ibuf_aio_reads'] = int(row[3])
+        results['pending_aio_log_ios'] = int(row[6])
+        results['pending_aio_sync_ios'] = int(row[9])
+    elif len(row) == 7:
+        results['pending_ibuf_aio_reads'] = 0
+        results['pending_aio_log_ios'] = 0
+        results['pending_aio_sync_ios'] = 0
+
+
+def _pending_flushes(results: Results, row: List[str], line: str,
+                     state: _ParserState):
+    if len(row) == 4:
+        # Pending flushes (fsync): 0
+        results['pending_buffer_pool_flushes'] = int(row[3])
+    else:
+        # Pending flushes (fsync) log: 0; buffer pool: 0
+        results['pending_log_flushes'] = int(row[4])
+        results['pending_buffer_pool_flushes'] = int(row[7])
+
+
+# INSERT BUFFER AND ADAPTIVE HASH INDEX
+
+def _ibuf_for_space(results: Results, row: List[str], line: str,
+                    state: _ParserState):
+    # Older InnoDB code seemed to be ready for an ibuf per tablespace.
+    # It had two lines in the output.  Newer has just one line, see
+    # below.
+    # Ibuf for space 0: size 1, free list len 887, seg size 889, is
+    # not empty
+    # Ibuf for space 0: size 1, free list len 887, seg size 889,
+    results['ibuf_size'] = int(row[5])
+    results['ibuf_free_list'] = int(row[9])
+    results['ibuf_segment_size'] = int(row[12])
+
+
+def _ibuf_size(results: Results, row: List[str], line: str,
+               state: _ParserState):
+    # Ibuf: size 1, free list len 4634, seg size 4636,
+    results['ibuf_size'] = int(row[2])
+    results['ibuf_free_list'] = int(row[6])
+    results['ibuf_segment_size'] = int(row[9])
+
+    if line.find('merges') > -1:
+        results['ibuf_merges'] = int(row[10])
+
+
+def _ibuf_merged_operations(results: Results, row: List[str], line: str,
+                            state: _ParserState):
+    # Output of show engine innodb status has changed in 5.5
+    # merged operations:
+    # insert 593983, delete mark 387006, delete 73092
+    results['ibuf_merged_inserts'] = int(row[1])
+    results['ibuf_merged_delete_marks'] = int(row[4])
+    results['ibuf_merged_deletes'] = int(row[6])
+    results['ibuf_merged'] = sum(
+        map(int, [row[1], row[4], row[6]]))
+
+
+def _ibuf_merged_recs(results: Results, row: List[str], line: str,
+                      state: _ParserState):
+    # 19817685 inserts, 19817684 merged recs, 3552620 merges
+    results['ibuf_merged_inserts'] = int(row[0])
+    results['ibuf_merged'] = int(row[2])
+    results['ibuf_merges'] = int(row[5])
+
+
+def _hash_table_size(results: Results, row: List[str], line: str,
+                     state: _ParserState):
+    # In some versions of InnoDB, the used cells is omitted.
+    # Hash table size 4425293, used cells 4229064, ....
+    # Hash table size 57374437, node heap has 72964 buffer(s) <--
+    # no used cells
+    results['hash_index_cells_total'] = int(row[3])
+    results['hash_index_cells_used'] = int(row[6]) \
+        if line.find('used cells') > 0 else 0
+
+
+# LOG
+
+def _log_ios_done(results: Results, row: List[str], line: str,
+                  state: _ParserState):
+    # 3430041 log i/o's done, 17.44 log i/o's/second
+    # 520835887 log i/o's done, 17.28 log i/o's/second, 518724686
+    # syncs, 2980893 checkpoints
+    results['log_writes'] = int(row[0])
+
+
+def _pending_log_writes(results: Results, row: List[str], line: str,
+                        state: _ParserState):
+    # 0 pending log writes, 0 pending chkp writes
+    results['pending_log_writes'] = int(row[0])
+    results['pending_checkpoint_writes'] = int(row[4])
+
+
+def _log_sequence_number(results: Results, row: List[str], line: str,
+                         state: _ParserState):
+    # This number is NOT printed in hex in InnoDB plugin.
+    # Log sequence number 272588624
+    results['lsn_current'] = int(row[3])
+
+
+def _log_flushed_up_to(results: Results, row: List[str], line: str,
+                       state: _ParserState):
+    # This number is NOT printed in hex in InnoDB plugin.
+    # Log flushed up to   272588624
+    results['lsn_flushed'] = int(row[4])
+
+
+def _last_checkpoint_at(results: Results, row: List[str], line: str,
+                        state: _ParserState):
+    # Last checkpoint at  272588624
+    results['lsn_last_checkpoint'] = int(row[3])
 
+
+# BUFFER POOL AND MEMORY
+
+def _total_memory_allocated(results: Results, row: List[str], line: str,
+                            state: _ParserState):
+    # Total memory allocated 29642194944; in additional pool
+    # allocated 0
+    # Total memory allocated by read views 96
+    results['mem_total'] = int(row[3])
+    results['mem_additional_pool'] = int(row[8])
+
+
+def _adaptive_hash_index(results: Results, row: List[str], line: str,
+                         state: _ParserState):
+    #   Adaptive hash index 1538240664     (186998824 + 1351241840)
+    results['mem_adaptive_hash'] = int(row[3])
+
+
+def _page_hash(results: Results, row: List[str], line: str,
+               state: _ParserState):
+    #   Page hash           11688584
+    results['mem_page_hash'] = int(row[2])
+
+
+def _dictionary_cache(results: Results, row: List[str], line: str,
+                      state: _ParserState):
+    #   Dictionary cache    145525560      (140250984 + 5274576)
+    results['mem_dictionary'] = int(row[2])
+
+
+def _file_system(results: Results, row: List[str], line: str,
+                 state: _ParserState):
+    #   File system         313848         (82672 + 231176)
+    results['mem_file_system'] = int(row[2])
+
+
+def _lock_system(results: Results, row: List[str], line: str,
+                 state: _ParserState):
+    #   Lock system         29232616       (29219368 + 13248)
+    results['mem_lock_system'] = int(row[2])
+
+
+def _recovery_system(results: Results, row: List[str], line: str,
+                     state: _ParserState):
+    #   Recovery system     0      (0 + 0)
+    results['mem_recovery_system'] = int(row[2])
+
+
+def _threads(results: Results, row: List[str], line: str,
+             state: _ParserState):
+    #   Threads             409336         (406936 + 2400)
+    results['mem_thread_hash'] = int(row[1])
+
+
+def _buffer_pool_size(results: Results, row: List[str], line: str,
+                      state: _ParserState):
+    # The " " after size is necessary to avoid matching the wrong line:
+    # Buffer pool size        1769471
+    # Buffer pool size, bytes 28991012864
+    if state.buffer_id == -1:
+        results['buffer_pool_pages_total'] = int(row[3])
+    elif state.buffer_pool is not None:
+        state.buffer_pool['pages_total'] = int(row[3])
+
+
+def _free_buffers(results: Results, row: List[str], line: str,
+                  state: _ParserState):
+    # Free buffers            0
+    if state.buffer_id == -1:
+        results['buffer_pool_pages_free'] = int(row[2])
+    elif state.buffer_pool is not None:
+        state.buffer_pool['pages_free'] = int(row[2])
+
+
+def _database_pages(results: Results, row: List[str], line: str,
+                    state: _ParserState):
+    # Database pages          1696503
+    if state.buffer_id == -1:
+        results['buffer_pool_pages_data'] = int(row[2])
+    elif state.buffer_pool is not None:
+        state.buffer_pool['pages_data'] = int(row[2])
+
+
+def _modified_db_pages(results: Results, row: List[str], line: str,
+                       state: _ParserState):
+    # Modified db pages       160602
+    if state.buffer_id == -1:
+        results['buffer_pool_pages_dirty'] = int(row[3])
+    elif state.buffer_pool is not None:
+        state.buffer_pool['pages_dirty'] = int(row[3])
+
+
+def _pages_read_ahead(results: Results, row: List[str], line: str,
+                      state: _ParserState):
+    # Must match BEFORE the next rule, otherwise it'll get fooled by
+    # this line from the new plugin:
+    # Pages read ahead 0.00/s, evicted without access 0.06/s
+    pass
+
+
+def _pages_read(results: Results, row: List[str], line: str,
+                state: _ParserState):
+    # Pages read 15240822, created 1770238, written 21705836
+    if state.buffer_id == -1:
+        results['pages_read'] = int(row[2])
+        results['pages_created'] = int(row[4])
+        results['pages_written'] = int(row[6])
+    elif state.buffer_pool is not None:
+        state.buffer_pool['pages_read'] = int(row[2])
+        state.buffer_pool['pages_created'] = int(row[4])
+        state.buffer_pool['pages_written'] = int(row[6])
+
+
+def _buffer_pool_hit_rate(results: Results, row: List[str], line: str,
+                          state: _ParserState):
+    # Buffer pool hit rate 999 / 1000, young-making rate 0 / 1000 not 0 /
+    # 1000
+    # Only per instance; the line is missing when there were no page gets
+    # since the previous output
+    if state.buffer_pool is not None and int(row[6]):
+        state.buffer_pool['hit_rate'] = int(row[4]) / int(row[6])
+
+
+# ROW OPERATIONS
+
+def _rows_inserted(results: Results, row: List[str], line: str,
+                   state: _ParserState):
+    # Number of rows inserted 50678311, updated 66425915, deleted
+    # 20605903, read 454561562
+    results['rows_inserted'] = int(row[4])
+    results['rows_updated'] = int(row[6])
+    results['rows_deleted'] = int(row[8])
+    results['rows_read'] = int(row[10])
+
+
+def _queries_inside(results: Results, row: List[str], line: str,
+                    state: _ParserState):
+    # 0 queries inside InnoDB, 0 queries in queue
+    results['queries_inside'] = int(row[0])
+    results['queries_queued'] = int(row[4])
+
+
+# Dispatch table; (needle, at_start, condition, handler)
+# When `at_start` is True the line must start with the needle, otherwise the
+# (first) needle must be found after the start of the line. Only the first
+# matching rule is applied so the order of the rules is significant.
+RULES: Tuple[Tuple[str, bool, Optional[Condition], Handler], ...] = (
+    ('Mutex spin waits', True, None, _mutex_spin_waits),
+    ('RW-shared spins', True,
+     lambda line, _: line.find(';') > 0, _rw_spins),
+    ('RW-shared spins', True,
+     lambda line, _: line.find('; RW-excl spins') == -1, _rw_shared_spins),
+    ('RW-excl spins', True, None, _rw_excl_spins),
+    ('seconds the semaphore:', False, None, _semaphore_wait),
+    ('Trx id counter', True, None, _trx_id_counter),
+    ('History list length', True, None, _history_list_length),
+    ('---TRANSACTION', True,
+     lambda _, state: state.txn_seen, _transaction),
+    ('read views open inside InnoDB', False, None, _read_views),
+    ('mysql tables in use', True, None, _tables_in_use),
+    ('lock struct(s)', False,
+     lambda _, state: state.txn_seen, _lock_structs),
+    (' OS file reads, ', False, None, _os_file_reads),
+    ('Pending normal aio reads:', True, None, _pending_normal_aio),
+    ('ibuf aio reads', True, None, _ibuf_aio_reads),
+    ('Pending flushes (fsync)', True, None, _pending_flushes),
+    ('Ibuf for space 0: size ', True, None, _ibuf_for_space),
+    ('Ibuf: size ', True, None, _ibuf_size),
+    (', delete mark ', False,
+     lambda _, state: state.prev_line.find('merged operations:') == 0,
+     _ibuf_merged_operations),
+    (' merged recs, ', False, None, _ibuf_merged_recs),
+    ('Hash table size ', True, None, _hash_table_size),
+    (" log i/o's done, ", False, None, _log_ios_done),
+    (" pending log writes, ", False, None, _pending_log_writes),
+    ("Log sequence number", True, None, _log_sequence_number),
+    ("Log flushed up to", True, None, _log_flushed_up_to),
+    ("Last checkpoint at", True, None, _last_checkpoint_at),
+    ("Total memory allocated", True,
+     lambda line, _: line.find("in additional pool allocated") > 0,
+     _total_memory_allocated),
+    ('Adaptive hash index ', True, None, _adaptive_hash_index),
+    ('Page hash           ', True, None, _page_hash),
+    ('Dictionary cache    ', True, None, _dictionary_cache),
+    ('File system         ', True, None, _file_system),
+    ('Lock system         ', True, None, _lock_system),
+    ('Recovery system     ', True, None, _recovery_system),
+    ('Threads             ', True, None, _threads),
+    ("Buffer pool size ", True, None, _buffer_pool_size),
+    ("Free buffers", True, None, _free_buffers),
+    ("Database pages", True, None, _database_pages),
+    ("Modified db pages", True, None, _modified_db_pages),
+    ("Pages read ahead", True, None, _pages_read_ahead),
+    ("Pages read", True, None, _pages_read),
+    ("Buffer pool hit rate", True, None, _buffer_pool_hit_rate),
+    ('Number of rows inserted', True, None, _rows_inserted),
+    (" queries inside InnoDB, ", False, None, _queries_inside),
+)
+
+
+def _build_dispatch(rules):
+    # Lines are looked up by their first `prefix_len` characters; each key
+    # maps to the rules which may match such a line, in table order. Lines
+    # with an unknown key only need to be tested against the substring rules.
+    prefix_len = min(len(needle) for needle, at_start, *_ in rules
+                     if at_start)
+    anywhere = [rule for rule in rules if not rule[1]]
+    dispatch: Dict[str, List[tuple]] = {}
+    for rule in rules:
+        needle, at_start, *_ = rule
+        if at_start:
+            dispatch.setdefault(needle[:prefix_len], [])
+
+    for key, candidates in dispatch.items():
+        candidates.extend(
+            rule for rule in rules
+            if not rule[1] or rule[0][:prefix_len] == key)
+    return prefix_len, tuple(anywhere), {
+        key: tuple(candidates) for key, candidates in dispatch.items()}
+
+
+_PREFIX_LEN, _ANYWHERE, _DISPATCH = _build_dispatch(RULES)
+
+
+def _add_derived_metrics(results: Results):
     # We need to calculate this metric separately
     try:
         results['checkpoint_age'] = results['lsn_current'] - \
@@ -365,26 +776,239 @@ def get_stats_from_innodb_status(innodb_status_text) -> Dict[str, Any]:
         logging.error("Not all InnoDB buffer pool metrics are available, "
                       f"unable to compute: {e}")
 
+
+def get_stats_from_innodb_status(
+        innodb_status_text,
+        page_size: Optional[int] = None,
+        buffer_pools: bool = False) -> Dict[str, Any]:
+    """With `buffer_pools`, the result contains a list with the metrics per
+    buffer pool instance as `buffer_pools`."""
+    results: Dict[str, Any] = defaultdict(int)
+    if page_size is not None:
+        # The page size is not part of the status output
+        results['page_size'] = page_size
+
+    # Here we now parse InnoDB STATUS one line at a time
+    # This is heavily inspired by the Percona monitoring plugins work
+    state = _ParserState(buffer_pools)
+    dispatch_get = _DISPATCH.get
+    for line in iter_lines(innodb_status_text):
+        line = line.strip()
+
+        if state.skip_transactions:
+            # Only count the remaining transactions and their locks, skip
+            # the lock details
+            if line.startswith('---TRANSACTION'):
+                _transaction(results, [], line, state)
+                continue
+            if line.startswith('mysql tables in use'):
+                _tables_in_use(results, _tokenize(line), line, state)
+                continue
+            if 'lock struct(s)' in line:
+                _lock_structs(results, _tokenize(line), line, state)
+                continue
+            if line not in _SECTIONS_AFTER_TRANSACTIONS:
+                continue
+            state.skip_transactions = False
+
+        if line.startswith('---BUFFER POOL'):
+            state.buffer_id = int(_tokenize(line)[2])
+            if state.buffer_pools is not None:
+                state.buffer_pool = {'name': str(state.buffer_id)}
+                state.buffer_pools.append(state.buffer_pool)
+
+        for needle, at_start, condition, handler in \
+                dispatch_get(line[:_PREFIX_LEN], _ANYWHERE):
+            # The `in` test is a cheap rejection for most lines
+            if needle in line and \
+                    (line.startswith(needle) if at_start
+                     else line.find(needle) > 0) and \
+                    (condition is None or condition(line, state)):
+                handler(results, _tokenize(line), line, state)
+                break
+
+        state.prev_line = line
+
+    _add_derived_metrics(results)
+    if state.buffer_pools is not None:
+        results['buffer_pools'] = state.buffer_pools
+    results['transactions_inspected'] = \
+        min(results['current_transactions'], INNODB_MAX_TRANSACTIONS) \
+        if INNODB_MAX_TRANSACTIONS else results['current_transactions']
+    return results
+
+
+def get_stats_from_metrics(
+        status: Dict[str, Any],
+        metrics: Dict[str, Any],
+        page_size: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    results: Dict[str, Any] = {}
+    if page_size is not None:
+        # Innodb_page_size (below) exists as of MySQL 5.6
+        results['page_size'] = page_size
+    for var_name, key in INNODB_STATUS_VARS.items():
+        if var_name in status:
+            results[key] = int(status[var_name])
+    if 'buffer_pool_pages_total' not in results:
+        # Without the Innodb_* status variables this source is useless
+        return None
+
+    for var_name, key in INNODB_METRICS_VARS.items():
+        if var_name in metrics and key not in results:
+            results[key] = int(metrics[var_name])
+
+    if 'ibuf_merged' not in results and all(
+            key in results for key in (
+                'ibuf_merged_inserts',
+                'ibuf_merged_delete_marks',
+                'ibuf_merged_deletes')):
+        results['ibuf_merged'] = \
+            results['ibuf_merged_inserts'] + \
+            results['ibuf_merged_delete_marks'] + \
+            results['ibuf_merged_deletes']
+
+    _add_derived_metrics(results)
     return results
 
 
+def _uptime(items: list) -> Optional[int]:
+    return int(items[0]['Value']) if items else None
+
+
+async def _check_metrics(
+        conn,
+        asset: Asset,
+        caps: Capabilities) -> Optional[Tuple[Dict[str, Any], Optional[int]]]:
+    if caps.version < (5, 6, 0) and caps.flavour != FLAVOUR_MARIADB:
+        # INNODB_METRICS does not exist before MySQL 5.6
+        logging.warning(
+            f'metrics source not available ({caps}), '
+            f'use InnoDB status instead; {asset}')
+        _no_metrics_source[asset.id] = caps
+        return None
+
+    # Only when the server lacks the tables or variables; Other errors are
+    # raised, the connection may have been closed
+    try:
+        res = await query_multi(conn, {
+            'status': QUERY_INNODB_STATUS_VARS,
+            'metrics': QUERY_INNODB_METRICS,
+            'uptime': QUERY_UPTIME,
+        })
+    except UnavailableError as e:
+        stats = uptime = None
+        reason = str(e)
+    else:
+        stats = get_stats_from_metrics(
+            {i['Variable_name']: i['Value'] for i in res['status']},
+            {i['NAME']: i['COUNT'] for i in res['metrics']},
+            caps.page_size)
+        uptime = _uptime(res['uptime'])
+        reason = 'no InnoDB status variables'
+
+    if stats is None:
+        logging.warning(
+            f'metrics source not available ({reason}), '
+            f'use InnoDB status instead; {asset}')
+        _no_metrics_source[asset.id] = caps
+        return None
+
+    return stats, uptime
+
+
+async def _check_status(conn) -> Tuple[str, Optional[int]]:
+    res = await query_multi(conn, {
+        'status': QUERY,
+        'uptime': QUERY_UPTIME,
+    })
+    assert len(res['status']), 'no INNODB STATUS metrics found'
+    return res['status'][0]['Status'], _uptime(res['uptime'])
+
+
+def _result(
+        asset: Asset,
+        config: dict,
+        caps: Capabilities,
+        timing: CheckTiming,
+        stats: Dict[str, Any],
+        item_probe: Dict[str, Any],
+        uptime: Optional[int]) -> dict:
+    update_uptime(asset, uptime)
+    buffer_pools = stats.pop('buffer_pools', None)
+    counters = _innodb_counters[item_probe['source']]
+    rates = counters.rates(asset.id, stats, uptime)
+    for key, rate in rates.items():
+        stats[f'{key}_rate'] = rate
+
+    stats['name'] = 'innodb'
+    item_probe.update(timing.as_item())
+    item_probe['name'] = 'innodb'
+
+    result = {
+        'innodb': [stats],
+        'probe': [item_probe],
+    }
+    if buffer_pools is not None:
+        for item in buffer_pools:
+            counters = _buffer_pool_counters.get(item['name'])
+            if counters is None:
+                counters = _buffer_pool_counters[item['name']] = \
+                    CounterStore(BUFFER_POOL_COUNTERS)
+            rates = counters.rates(asset.id, item, uptime)
+            for key, rate in rates.items():
+                item[f'{key}_rate'] = rate
+        result['innodb_buffer_pool'] = buffer_pools
+    if config.get('payload', PAYLOAD_FULL) == PAYLOAD_DELTA:
+        item_probe.update(compact_result('innodb', asset.id, caps, result))
+    return result
+
+
 async def check_innodb(
         asset: Asset,
         asset_config: dict,
         config: dict) -> dict:
 
-    conn = await get_conn(asset, asset_config, config)
-    try:
-        res = await query(conn, QUERY_HAS_INNODB)
-        if len(res) == 0:
+    timing = start_timing()
+    source = config.get('source', SOURCE_STATUS)
+    # On a busy server, the metrics source is used instead of the (more
+    # expensive) InnoDB status; without metrics source the run is skipped
+    tier, reason = load_tier(asset.id)
+    item_probe: Dict[str, Any] = {'tier': tier}
+    if reason:
+        item_probe['tier_reason'] = reason
+
+    async with get_conn(asset, asset_config, config) as conn:
+        caps = await get_capabilities(conn, asset)
+        if not caps.has_innodb:
             raise IgnoreCheckException
-        res = await query(conn, "SHOW /*!50000 ENGINE*/ INNODB STATUS")
-        assert len(res), 'no INNODB STATUS metrics found'
-        stats = get_stats_from_innodb_status(res[0]['Status'])
-        stats['name'] = 'innodb'
-    finally:
-        conn.close()
-
-    return {
-        'innodb': [stats]
-    }
+        if (source == SOURCE_METRICS or tier == TIER_LIGHT) and \
+                _no_metrics_source.get(asset.id) is not caps:
+            res = await _check_metrics(conn, asset, caps)
+            if res is not None:
+                stats, uptime = res
+                item_probe['source'] = SOURCE_METRICS
+                return _result(
+                    asset, config, caps, timing, stats, item_probe, uptime)
+        if tier == TIER_LIGHT:
+            logging.info(f'skip InnoDB status ({reason}); {asset}')
+            item_probe.update(timing.as_item())
+            item_probe['name'] = 'innodb'
+            return {'probe': [item_probe]}
+        status, uptime = await _check_status(conn)
+
+    # Metrics per buffer pool instance are only in the InnoDB status
+    parser = functools.partial(
+        get_stats_from_innodb_status,
+        page_size=caps.page_size,
+        buffer_pools=bool(config.get('buffer_pools', False)))
+    async with parses.slot(config.get('address') or asset.name):
+        stats, item_parse = await run_parser(parser, status, len(status))
+    record_load(
+        asset.id,
+        queries_queued=stats.get('queries_queued'),
+        semaphore_waits=stats.get('semaphore_waits'))
+    item_probe.update(item_parse)
+    item_probe['source'] = SOURCE_STATUS
+    item_probe['transactions_inspected'] = \
+        stats.pop('transactions_inspected')
+    return _result(asset, config, caps, timing, stats, item_probe, uptime)
@@ -0,0 +1,305 @@
+"""InnoDB lock waits, from performance_schema.data_lock_waits (MySQL 8.0) or
+information_schema.INNODB_LOCK_WAITS (MySQL 5.x and MariaDB)
+
+https://dev.mysql.com/doc/refman/8.0/en/performance-schema-data-lock-waits-table.html
+
+The lock waits form a wait-for graph between transactions. Each run returns
+the top blocking sessions, by number of waiters and by the longest wait of
+their waiters, and the longest chains of sessions waiting on each other.
+The transactions are only read when there are lock waits, and joined with
+the lock waits in the probe (the join on the server is not indexed). The
+graph work is linear in the number of lock waits, which is limited to
+LOCKS_MAX_EDGES, except for counting the exact number of sessions blocked
+by the candidates for the top blockers (at most LOCKS_MAX_EXACT).
+"""
+import heapq
+import os
+from collections import deque
+from libprobe.asset import Asset
+from libprobe.exceptions import IgnoreCheckException
+from lib.capabilities import FLAVOUR_MARIADB, get_capabilities
+from lib.query import get_conn, query
+from lib.timing import start_timing
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+DEFAULT_TOP_N = 10
+DEFAULT_MIN_CHAIN_LENGTH = 3
+
+# Maximum number of lock waits read per run
+LOCKS_MAX_EDGES = int(os.getenv('LOCKS_MAX_EDGES', 10000))
+# Query text of blocking sessions is truncated to this number of characters
+LOCKS_MAX_TEXT = 1024
+# Maximum number of blockers for which the exact number of blocked sessions
+# is counted to rank the top blockers
+LOCKS_MAX_EXACT = 50
+
+SOURCE_DATA_LOCK_WAITS = 'data_lock_waits'
+SOURCE_INNODB_LOCK_WAITS = 'innodb_lock_waits'
+
+QUERY_DATA_LOCK_WAITS = """\
+SELECT DISTINCT
+    REQUESTING_ENGINE_TRANSACTION_ID AS waiting,
+    BLOCKING_ENGINE_TRANSACTION_ID AS blocking
+FROM performance_schema.data_lock_waits
+LIMIT {limit}
+"""
+QUERY_INNODB_LOCK_WAITS = """\
+SELECT DISTINCT requesting_trx_id AS waiting, blocking_trx_id AS blocking
+FROM information_schema.INNODB_LOCK_WAITS
+LIMIT {limit}
+"""
+QUERY_TRX = """\
+SELECT
+    trx_id, trx_mysql_thread_id, trx_state, trx_rows_locked,
+    TIMESTAMPDIFF(SECOND, trx_started, NOW()) AS trx_age,
+    TIMESTAMPDIFF(SECOND, trx_wait_started, NOW()) AS wait_age
+FROM information_schema.INNODB_TRX
+"""
+QUERY_TRX_TEXT = """\
+SELECT trx_id, LEFT(trx_query, {max_text}) AS trx_query
+FROM information_schema.INNODB_TRX
+WHERE trx_mysql_thread_id IN ({thread_ids})
+"""
+
+# Transaction Id: [blocking transaction Id's] and the reverse
+Graph = Dict[str, List[str]]
+
+
+def _post_order(graph: Graph) -> Tuple[List[str], int]:
+    """Returns the transactions in the graph, each after the transactions it
+    points to, and the number of cycles found. Iterative depth-first search;
+    a cycle (a deadlock not yet resolved by InnoDB) is cut at the edge which
+    closes it."""
+    order: List[str] = []
+    done: Set[str] = set()
+    on_stack: Set[str] = set()
+    cycles = 0
+    for start in graph:
+        if start in done:
+            continue
+        on_stack.add(start)
+        stack = [(start, iter(graph[start]))]
+        while stack:
+            trx_id, it = stack[-1]
+            for other in it:
+                if other in done:
+                    continue
+                if other in on_stack:
+                    cycles += 1
+                    continue
+                on_stack.add(other)
+                stack.append((other, iter(graph.get(other, ()))))
+                break
+            else:
+                stack.pop()
+                on_stack.discard(trx_id)
+                done.add(trx_id)
+                order.append(trx_id)
+    return order, cycles
+
+
+def _depths(blocked_by: Graph) -> Tuple[Dict[str, int], Dict[str, str], int]:
+    """Returns the length of the longest chain from each transaction to a
+    transaction which is not waiting, the next transaction in that chain and
+    the number of cycles."""
+    order, cycles = _post_order(blocked_by)
+    depth: Dict[str, int] = {}
+    nxt: Dict[str, str] = {}
+    for trx_id in order:
+        best = 1
+        for blocking in blocked_by.get(trx_id, ()):
+            # Not yet known when the edge closes a cycle
+            d = depth.get(blocking)
+            if d is not None and d + 1 > best:
+                best = d + 1
+                nxt[trx_id] = blocking
+        depth[trx_id] = best
+    return depth, nxt, cycles
+
+
+def _waiting_totals(waiters: Graph) -> Dict[str, int]:
+    # Number of transactions waiting on each transaction, directly or not;
+    # A transaction waiting on several chains (shared locks) is counted in
+    # each, thus this is exact for trees and an upper bound otherwise. The
+    # bound is capped at the number of transactions, as paths multiply
+    order, _ = _post_order(waiters)
+    cap = len(order) - 1
+    totals: Dict[str, int] = {}
+    for trx_id in order:
+        totals[trx_id] = min(cap, sum(
+            1 + totals.get(waiting, 0)
+            for waiting in waiters.get(trx_id, ())))
+    return totals
+
+
+def _blocked_total(waiters: Graph, trx_id: str) -> int:
+    # Number of transactions waiting on this transaction, directly or not
+    seen = {trx_id}
+    todo = deque((trx_id,))
+    while todo:
+        for waiting in waiters.get(todo.popleft(), ()):
+            if waiting not in seen:
+                seen.add(waiting)
+                todo.append(waiting)
+    return len(seen) - 1
+
+
+def _blocked_totals(
+        waiters: Graph,
+        top_n: int) -> Tuple[Dict[str, int], bool]:
+    """Returns the exact number of transactions blocked (directly or not)
+    by the top blockers by that number, and whether the top is exact.
+    Blockers are counted in the order of their upper bound, until no other
+    blocker can make the top; at most LOCKS_MAX_EXACT blockers are
+    counted."""
+    bounds = _waiting_totals(waiters)
+    exact: Dict[str, int] = {}
+    # The top_n exact counts so far
+    top: List[int] = []
+    for trx_id in heapq.nlargest(
+            LOCKS_MAX_EXACT, waiters, key=bounds.__getitem__):
+        if len(top) == top_n and top[0] >= bounds[trx_id]:
+            return exact, True
+        exact[trx_id] = total = _blocked_total(waiters, trx_id)
+        if len(top) < top_n:
+            heapq.heappush(top, total)
+        elif total > top[0]:
+            heapq.heapreplace(top, total)
+    return exact, len(exact) == len(waiters)
+
+
+def _top(n: int, entries: List[tuple]) -> List[str]:
+    return [entry[-1] for entry in heapq.nlargest(n, entries)]
+
+
+def _session(trx_id: str, trx: Optional[Any]) -> Dict[str, Any]:
+    if trx is None:
+        # The transaction has ended between the queries
+        return {'name': trx_id, 'trx_id': trx_id}
+    thread_id = trx.trx_mysql_thread_id
+    return {
+        # Recovered and prepared XA transactions have no session
+        'name': str(thread_id) if thread_id else trx_id,
+        'trx_id': trx_id,
+        'thread_id': thread_id,
+        'trx_state': trx.trx_state,
+        'trx_age': trx.trx_age,
+        'trx_rows_locked': trx.trx_rows_locked,
+    }
+
+
+async def check_locks(
+        asset: Asset,
+        asset_config: dict,
+        config: dict) -> dict:
+
+    timing = start_timing()
+    top_n = int(config.get('top_n', DEFAULT_TOP_N))
+    min_chain_length = int(
+        config.get('min_chain_length', DEFAULT_MIN_CHAIN_LENGTH))
+
+    trx: Dict[str, Any] = {}
+    texts: Dict[str, str] = {}
+    async with get_conn(asset, asset_config, config) as conn:
+        caps = await get_capabilities(conn, asset)
+        if not caps.has_innodb:
+            raise IgnoreCheckException
+        if caps.flavour != FLAVOUR_MARIADB and caps.version >= (8, 0, 1):
+            # INNODB_LOCK_WAITS has been removed in MySQL 8.0
+            if not caps.has_performance_schema:
+                raise IgnoreCheckException
+            source = SOURCE_DATA_LOCK_WAITS
+            sql = QUERY_DATA_LOCK_WAITS
+        else:
+            source = SOURCE_INNODB_LOCK_WAITS
+            sql = QUERY_INNODB_LOCK_WAITS
+
+        edges = await query(
+            conn, sql.format(limit=LOCKS_MAX_EDGES), as_records=True)
+        if edges:
+            for row in await query(conn, QUERY_TRX, as_records=True):
+                trx[str(row.trx_id)] = row
+
+        blocked_by: Graph = {}
+        waiters: Graph = {}
+        for row in edges:
+            waiting, blocking = str(row.waiting), str(row.blocking)
+            blocked_by.setdefault(waiting, []).append(blocking)
+            waiters.setdefault(blocking, []).append(waiting)
+
+        def wait_age(trx_id: str) -> int:
+            row = trx.get(trx_id)
+            return (row.wait_age or 0) if row is not None else 0
+
+        # Top blockers by number of (direct and indirect) waiters and by the
+        # longest wait of their direct waiters; the trx Id makes the entries
+        # unique
+        totals, blockers_exact = _blocked_totals(waiters, top_n)
+        by_waiters = []
+        by_wait_age = []
+        max_wait_age: Dict[str, int] = {}
+        for blocking, waiting in waiters.items():
+            max_wait_age[blocking] = age = max(map(wait_age, waiting))
+            if blocking in totals:
+                by_waiters.append((totals[blocking], age, blocking))
+            by_wait_age.append((age, len(waiting), blocking))
+        top = dict.fromkeys(
+            _top(top_n, by_waiters) + _top(top_n, by_wait_age))
+
+        thread_ids = {
+            int(trx[trx_id].trx_mysql_thread_id) for trx_id in top
+            if trx_id in trx and trx[trx_id].trx_mysql_thread_id}
+        if thread_ids:
+            for row in await query(conn, QUERY_TRX_TEXT.format(
+                    max_text=LOCKS_MAX_TEXT,
+                    thread_ids=', '.join(map(str, thread_ids))),
+                    as_records=True):
+                texts[str(row.trx_id)] = row.trx_query
+
+    blockers = []
+    for trx_id in top:
+        item = _session(trx_id, trx.get(trx_id))
+        item['waiters'] = len(waiters[trx_id])
+        item['blocked_total'] = totals[trx_id] if trx_id in totals \
+            else _blocked_total(waiters, trx_id)
+        item['max_wait_age'] = max_wait_age[trx_id]
+        # A root blocker is not waiting itself
+        item['is_root'] = trx_id not in blocked_by
+        item['trx_query'] = texts.get(trx_id)
+        blockers.append(item)
+
+    # Chains start at a waiting transaction which is not blocking others
+    depth, nxt, cycles = _depths(blocked_by)
+    heads = [
+        (d, wait_age(trx_id), trx_id) for trx_id, d in depth.items()
+        if d >= min_chain_length and trx_id not in waiters]
+    chains = []
+    for trx_id in _top(top_n, heads):
+        path = [trx_id]
+        while path[-1] in nxt:
+            path.append(nxt[path[-1]])
+        sessions = [_session(i, trx.get(i))['name'] for i in path]
+        chains.append({
+            'name': sessions[0],
+            'length': len(path),
+            'path': ' > '.join(sessions),
+            'root': sessions[-1],
+            'wait_age': wait_age(trx_id),
+        })
+
+    item_probe = timing.as_item()
+    item_probe['name'] = 'locks'
+    item_probe['source'] = source
+    item_probe['lock_waits'] = len(edges)
+    item_probe['lock_waits_truncated'] = len(edges) >= LOCKS_MAX_EDGES
+    item_probe['waiting_sessions'] = len(blocked_by)
+    item_probe['blocking_sessions'] = len(waiters)
+    item_probe['cycles'] = cycles
+    item_probe['blockers_exact'] = blockers_exact
+
+    return {
+        'blockers': blockers,
+        'chains': chains,
+        'probe': [item_probe],
+    }
@@ -5,9 +5,19 @@ https://dev.mysql.com/doc/refman/8.0/en/server-status-variable-reference.html
 Server variables:
 https://dev.mysql.com/doc/refman/8.0/en/server-system-variable-reference.html
 """
+import logging
+import os
+import time
 from libprobe.asset import Asset
-from lib.query import get_conn, query_flat
-from typing import Dict, Any
+from lib.capabilities import FLAVOUR_MARIADB, Capabilities, \
+    get_capabilities, update_uptime
+from lib.counters import CounterStore
+from lib.load import TIER_LIGHT, load_tier, record_load
+from lib.payload import PAYLOAD_DELTA, PAYLOAD_FULL, compact_result
+from lib.query import UnavailableError, get_conn, in_list, query_flat, \
+    query_multi_flat
+from lib.timing import start_timing
+from typing import Dict, Any, Tuple
 
 
 QUERY_STATUS = "SHOW /*!50002 GLOBAL */ STATUS"
@@ -46,7 +56,6 @@ STATUS_VARS = {
     'Qcache_lowmem_prunes': int,
     # Table Lock Metrics
     'Table_locks_waited': int,
-    'Table_locks_waited_rate': int,
     # Temporary Table Metrics
     'Created_tmp_tables': int,
     'Created_tmp_disk_tables': int,
@@ -92,9 +101,10 @@ STATUS_VARS = {
     'Sort_rows': int,
     'Sort_scan': int,
     'Table_locks_immediate': int,
-    'Table_locks_immediate_rate': int,
     'Threads_cached': int,
     'Threads_created': int,
+    # Server Metrics
+    'Uptime': int,
 
     # TODO ook deze?
     # 'Caching_sha2_password_rsa_public_key': str,
@@ -121,6 +131,67 @@ STATUS_VARS = {
     # 'Tls_library_version': str,
 }
 
+# Monotonic counters in STATUS_VARS; For each of these counters a per-second
+# rate is added as `<name>_rate`
+STATUS_COUNTERS = (
+    'Slow_queries',
+    'Questions',
+    'Queries',
+    'Com_select',
+    'Com_insert',
+    'Com_update',
+    'Com_delete',
+    'Com_replace',
+    'Com_load',
+    'Com_insert_select',
+    'Com_update_multi',
+    'Com_delete_multi',
+    'Com_replace_select',
+    'Connections',
+    'Aborted_clients',
+    'Aborted_connects',
+    'Bytes_sent',
+    'Bytes_received',
+    'Qcache_hits',
+    'Qcache_inserts',
+    'Qcache_lowmem_prunes',
+    'Qcache_not_cached',
+    'Table_locks_waited',
+    'Table_locks_immediate',
+    'Created_tmp_tables',
+    'Created_tmp_disk_tables',
+    'Created_tmp_files',
+    'Key_read_requests',
+    'Key_reads',
+    'Key_write_requests',
+    'Key_writes',
+    'Binlog_cache_disk_use',
+    'Binlog_cache_use',
+    'Handler_commit',
+    'Handler_delete',
+    'Handler_prepare',
+    'Handler_read_first',
+    'Handler_read_key',
+    'Handler_read_next',
+    'Handler_read_prev',
+    'Handler_read_rnd',
+    'Handler_read_rnd_next',
+    'Handler_rollback',
+    'Handler_update',
+    'Handler_write',
+    'Opened_tables',
+    'Select_full_join',
+    'Select_full_range_join',
+    'Select_range',
+    'Select_range_check',
+    'Select_scan',
+    'Sort_merge_passes',
+    'Sort_range',
+    'Sort_rows',
+    'Sort_scan',
+    'Threads_created',
+)
+
 VARIABLES_VARS = {
     'key_buffer_size': int,
     'max_connections': int,
@@ -132,17 +203,123 @@ VARIABLES_VARS = {
 }
 
 
+QUERY_STATUS_PS = f"""\
+SELECT VARIABLE_NAME, VARIABLE_VALUE
+FROM performance_schema.global_status
+WHERE VARIABLE_NAME IN ({in_list(STATUS_VARS)})
+"""
+QUERY_VARIABLES_PS = f"""\
+SELECT VARIABLE_NAME, VARIABLE_VALUE
+FROM performance_schema.global_variables
+WHERE VARIABLE_NAME IN ({in_list(VARIABLES_VARS)})
+"""
+QUERY_STATUS_WHERE = f"""\
+SHOW GLOBAL STATUS
+WHERE Variable_name IN ({in_list(STATUS_VARS)})
+"""
+QUERY_VARIABLES_WHERE = f"""\
+SHOW GLOBAL VARIABLES
+WHERE Variable_name IN ({in_list(VARIABLES_VARS)})
+"""
+
+# Collection modes, from cheapest to most expensive; The last mode is the
+# full SHOW and works on every server
+COLLECT_MODES = (
+    ('performance_schema', QUERY_STATUS_PS, QUERY_VARIABLES_PS),
+    ('filtered', QUERY_STATUS_WHERE, QUERY_VARIABLES_WHERE),
+    ('full', QUERY_STATUS, QUERY_VARIABLES),
+)
+
+# Global variables are re-read after this number of seconds, or when the
+# server has been restarted
+VARIABLES_TTL = float(os.getenv('VARIABLES_TTL', 3600))
+
+
+def _initial_mode(caps: Capabilities) -> int:
+    # performance_schema.global_status exists as of MySQL 5.7 but not in
+    # MariaDB; SHOW ... WHERE works on all supported versions
+    if caps.has_performance_schema and caps.flavour != FLAVOUR_MARIADB and \
+            caps.version >= (5, 7, 0):
+        return 0
+    return 1
+
+
+class _VariablesCache:
+    __slots__ = ('item', 'uptime', 'expire', 'hits', 'misses')
+
+    def __init__(self):
+        self.item: Dict[str, Any] = {}
+        self.uptime = 0
+        self.expire = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def is_expired(self, now: float) -> bool:
+        return not self.item or now >= self.expire
+
+
+# Collection mode per asset Id, with the capabilities it was chosen for
+_collect_mode: Dict[int, Tuple[Capabilities, int]] = {}
+# Variables cache per asset Id
+_variables_cache: Dict[int, _VariablesCache] = {}
+# Previous counter values per asset Id
+_status_counters = CounterStore(STATUS_COUNTERS)
+
+
 async def check_mysql(
         asset: Asset,
         asset_config: dict,
         config: dict) -> dict:
 
-    conn = await get_conn(asset, asset_config, config)
-    try:
-        status = await query_flat(conn, QUERY_STATUS)
-        variables = await query_flat(conn, QUERY_VARIABLES)
-    finally:
-        conn.close()
+    timing = start_timing()
+    cache = _variables_cache.get(asset.id)
+    if cache is None:
+        cache = _variables_cache[asset.id] = _VariablesCache()
+    # On a busy server, expired variables are kept until the load is lower
+    tier, reason = load_tier(asset.id)
+
+    variables = None
+    async with get_conn(asset, asset_config, config) as conn:
+        caps = await get_capabilities(conn, asset)
+        prev_caps, mode = _collect_mode.get(asset.id, (None, 0))
+        if prev_caps is not caps:
+            mode = _initial_mode(caps)
+        while True:
+            _, query_status, query_variables = COLLECT_MODES[mode]
+            now = time.monotonic()
+            queries = {'status': query_status}
+            if cache.is_expired(now) and (
+                    tier != TIER_LIGHT or not cache.item):
+                queries['variables'] = query_variables
+            try:
+                res = await query_multi_flat(conn, queries)
+                status = res['status']
+                # An empty result is returned when performance_schema is
+                # disabled
+                if not status:
+                    raise UnavailableError('no status variables found')
+                variables = res.get('variables')
+                uptime = int(status.get('Uptime', 0))
+                if variables is None and uptime < cache.uptime:
+                    # The server has been restarted; this requires an extra
+                    # round trip but only once after a restart
+                    variables = await query_flat(conn, query_variables)
+            except UnavailableError as e:
+                # Only when the server lacks the table or the user may not
+                # read it; Other errors are raised and the mode is kept, the
+                # connection may have been closed
+                if mode == len(COLLECT_MODES) - 1:
+                    raise
+                mode += 1
+                logging.warning(
+                    'fall back to collection mode '
+                    f'`{COLLECT_MODES[mode][0]}` ({e}); {asset}')
+            else:
+                break
+    _collect_mode[asset.id] = caps, mode
+    update_uptime(asset, uptime)
+    if 'Threads_running' in status:
+        record_load(asset.id, threads_running=int(status['Threads_running']))
 
     item: Dict[str, Any] = {
         'name': 'status',
@@ -152,14 +329,37 @@ async def check_mysql(
             name = var_name.lower()  # lowercase metricnames
             item[name] = var_type(status[var_name])
 
-    item_variables: Dict[str, Any] = {
-        'name': 'variables',
-    }
-    for var_name, var_type in VARIABLES_VARS.items():
-        if var_name in variables:
-            item_variables[var_name] = var_type(variables[var_name])
+    rates = _status_counters.rates(asset.id, status, uptime)
+    for var_name, rate in rates.items():
+        item[f'{var_name.lower()}_rate'] = rate
+
+    if variables is None:
+        cache.hits += 1
+    else:
+        item_variables: Dict[str, Any] = {
+            'name': 'variables',
+        }
+        for var_name, var_type in VARIABLES_VARS.items():
+            if var_name in variables:
+                item_variables[var_name] = var_type(variables[var_name])
+        cache.item = item_variables
+        cache.expire = now + VARIABLES_TTL
+        cache.misses += 1
+    cache.uptime = uptime
+
+    item_probe = timing.as_item()
+    item_probe['name'] = 'mysql'
+    item_probe['tier'] = tier
+    if reason:
+        item_probe['tier_reason'] = reason
+    item_probe['variables_cache_hits'] = cache.hits
+    item_probe['variables_cache_misses'] = cache.misses
 
-    return {
+    result = {
         'status': [item],
-        'variables': [item_variables]
+        'variables': [dict(cache.item)],
+        'probe': [item_probe],
     }
+    if config.get('payload', PAYLOAD_FULL) == PAYLOAD_DELTA:
+        item_probe.update(compact_result('mysql', asset.id, caps, result))
+    return result
@@ -0,0 +1,207 @@
+"""Per-table I/O and lock waits, from
+performance_schema.table_io_waits_summary_by_table and
+performance_schema.table_lock_waits_summary_by_table
+
+https://dev.mysql.com/doc/refman/8.0/en/performance-schema-table-wait-summary-tables.html
+
+The summary tables hold cumulative values; each run returns the change since
+the previous run for the tables with the most wait time. Both tables are read
+once, unordered and unbuffered; their indexes (if any) are hash indexes, thus
+a join, sort or keyset pagination on the server would scan the table for
+every page or row. The lock waits are joined in the probe instead, using the
+same sorted array of 64-bit name hashes as the previous values, which are
+kept with 5 doubles per table, thus 48 bytes per table, for at most
+TABLES_MAX_STATE tables per asset.
+"""
+import heapq
+import os
+from array import array
+from bisect import bisect_left
+from libprobe.asset import Asset
+from libprobe.exceptions import IgnoreCheckException
+from lib.capabilities import get_capabilities, update_uptime
+from lib.query import get_conn, query, query_stream
+from lib.timing import start_timing
+from typing import Any, Dict, List, Optional, Tuple
+
+
+DEFAULT_MIN_WAIT_TIME = 0.1
+DEFAULT_MAX_ITEMS = 100
+
+# Maximum number of tables per asset for which the previous values are kept;
+# Other tables are counted as `tables_untracked` in the probe item
+TABLES_MAX_STATE = int(os.getenv('TABLES_MAX_STATE', 200000))
+
+QUERY_IO = """\
+SELECT
+    OBJECT_SCHEMA, OBJECT_NAME, COUNT_READ, COUNT_WRITE, SUM_TIMER_WAIT
+FROM performance_schema.table_io_waits_summary_by_table
+WHERE OBJECT_TYPE = 'TABLE'
+    AND OBJECT_SCHEMA NOT IN ('mysql', 'performance_schema', 'sys')
+"""
+# Tables without lock waits are not needed
+QUERY_LOCK = """\
+SELECT OBJECT_SCHEMA, OBJECT_NAME, COUNT_STAR, SUM_TIMER_WAIT
+FROM performance_schema.table_lock_waits_summary_by_table
+WHERE OBJECT_TYPE = 'TABLE'
+    AND OBJECT_SCHEMA NOT IN ('mysql', 'performance_schema', 'sys')
+    AND COUNT_STAR > 0
+"""
+QUERY_UPTIME = "SHOW GLOBAL STATUS LIKE 'Uptime'"
+
+# Cumulative values in the order of the query
+COUNTERS = (
+    'reads',
+    'writes',
+    'io_wait_time',
+    'lock_waits',
+    'lock_wait_time',
+)
+N = len(COUNTERS)
+
+
+class _TableState:
+    __slots__ = ('hashes', 'values', 'width', 'uptime')
+
+    def __init__(self, hashes: array, values: array, width: int = N):
+        # Sorted name hashes and, for each hash, `width` values
+        self.hashes = hashes
+        self.values = values
+        self.width = width
+        # Uptime of the server when the values were read
+        self.uptime = 0
+
+    def get(self, h: int) -> Optional[array]:
+        idx = bisect_left(self.hashes, h)
+        if idx < len(self.hashes) and self.hashes[idx] == h:
+            return self.values[idx * self.width:(idx + 1) * self.width]
+        return None
+
+
+# Previous values per asset Id
+_state: Dict[int, _TableState] = {}
+
+
+def _sorted_state(
+        hashes: array,
+        values: array,
+        width: int = N) -> _TableState:
+    order = sorted(range(len(hashes)), key=hashes.__getitem__)
+    sorted_values = array('d')
+    for idx in order:
+        sorted_values.extend(values[idx * width:(idx + 1) * width])
+    return _TableState(array('q', (hashes[idx] for idx in order)),
+                       sorted_values, width)
+
+
+def _name_hash(schema: str, name: str) -> int:
+    # The built-in hash is 64-bit and only needs to be stable within the
+    # process, like the state itself
+    return hash((schema, name))
+
+
+def _item(schema: str, name: str, delta: List[float]) -> Dict[str, Any]:
+    item: Dict[str, Any] = dict(zip(COUNTERS, delta))
+    item['name'] = f'{schema}.{name}'
+    item['schema'] = schema
+    item['table'] = name
+    # Timer values are in picoseconds
+    item['io_wait_time'] /= 1e12
+    item['lock_wait_time'] /= 1e12
+    for key in ('reads', 'writes', 'lock_waits'):
+        item[key] = int(item[key])
+    return item
+
+
+async def check_tables(
+        asset: Asset,
+        asset_config: dict,
+        config: dict) -> dict:
+
+    timing = start_timing()
+    # Only tables with at least this number of seconds I/O and lock wait
+    # time since the previous run are returned
+    min_wait = float(config.get('min_wait_time', DEFAULT_MIN_WAIT_TIME)) * 1e12
+    max_items = int(config.get('max_items', DEFAULT_MAX_ITEMS))
+    prev = _state.get(asset.id)
+
+    hashes = array('q')
+    values = array('d')
+    # Bounded heap with (wait time, counter, schema, name, delta)
+    heap: List[Tuple[float, int, str, str, List[float]]] = []
+    n = untracked = 0
+    async with get_conn(asset, asset_config, config) as conn:
+        caps = await get_capabilities(conn, asset)
+        if not caps.has_performance_schema:
+            raise IgnoreCheckException
+
+        res = await query(conn, QUERY_UPTIME)
+        uptime = int(res[0]['Value']) if res else None
+        # The counters restart at zero with the server and may have grown
+        # past the previous values already
+        restarted = prev is not None and uptime is not None and \
+            uptime < prev.uptime
+
+        lock_hashes = array('q')
+        lock_values = array('d')
+        async for rows in query_stream(conn, QUERY_LOCK, as_records=True):
+            for row in rows:
+                lock_hashes.append(
+                    _name_hash(row.OBJECT_SCHEMA, row.OBJECT_NAME))
+                lock_values.append(float(row.COUNT_STAR or 0))
+                lock_values.append(float(row.SUM_TIMER_WAIT or 0))
+        locks = _sorted_state(lock_hashes, lock_values, 2)
+
+        async for rows in query_stream(conn, QUERY_IO, as_records=True):
+            for row in rows:
+                h = _name_hash(row.OBJECT_SCHEMA, row.OBJECT_NAME)
+                cur = [float(v or 0) for v in row[2:]]
+                cur.extend(locks.get(h) or (0.0, 0.0))
+                if len(hashes) < TABLES_MAX_STATE:
+                    hashes.append(h)
+                    values.extend(cur)
+                else:
+                    untracked += 1
+
+                old = None if prev is None else prev.get(h)
+                if old is None:
+                    continue
+                if restarted or cur[0] + cur[1] < old[0] + old[1]:
+                    # The summary table was truncated or the server has
+                    # been restarted
+                    wait = cur[2] + cur[4]
+                    if wait < min_wait:
+                        continue
+                    delta = cur
+                else:
+                    wait = cur[2] - old[2] + cur[4] - old[4]
+                    if wait < min_wait:
+                        continue
+                    delta = [c - o for c, o in zip(cur, old)]
+                n += 1
+                entry = (wait, n, row.OBJECT_SCHEMA, row.OBJECT_NAME, delta)
+                if len(heap) < max_items:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+    update_uptime(asset, uptime)
+    state = _state[asset.id] = _sorted_state(hashes, values)
+    state.uptime = uptime or 0
+
+    items = [
+        _item(schema, name, delta)
+        for _, _, schema, name, delta in heapq.nlargest(max_items, heap)]
+
+    item_probe = timing.as_item()
+    item_probe['name'] = 'tables'
+    item_probe['tables_lock_waits'] = len(locks.hashes)
+    item_probe['tables_changed'] = n
+    item_probe['tables_tracked'] = len(hashes)
+    item_probe['tables_untracked'] = untracked
+    item_probe['first_run'] = prev is None
+
+    return {
+        'tables': items,
+        'probe': [item_probe],
+    }
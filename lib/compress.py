@@ -0,0 +1,110 @@
+"""MySQL protocol compression, which aiomysql does not implement.
+
+The compression flag is sent in the handshake; once the connection is
+authenticated, the stream reader and writer of the aiomysql connection are
+replaced by wrappers which (un)wrap the packets in compressed packets (7 byte
+header with the compressed length, sequence Id and uncompressed length).
+
+https://dev.mysql.com/doc/dev/mysql-server/latest/page_protocol_basic_compression.html
+
+With `compress: "auto"`, connections for an asset are compressed when a check
+of the asset received more than COMPRESS_THRESHOLD bytes in its last run.
+"""
+import os
+import struct
+import zlib
+from typing import Dict
+from .timing import add_bytes_saved, count_bytes_received, received_bytes
+
+
+COMPRESS_AUTO = 'auto'
+
+COMPRESS_THRESHOLD = int(os.getenv('COMPRESS_THRESHOLD', 65536))
+# Packets sent by the probe are only compressed from this size; the same as
+# the MySQL client
+MIN_COMPRESS_LENGTH = 50
+
+
+class _CompressedReader:
+    # Bytes are counted on the underlying reader (the compressed bytes) by
+    # count_bytes_received(), not again on this reader
+    counted = True
+
+    def __init__(self, reader):
+        self._reader = reader
+        self._buf = bytearray()
+        # Compressed sequence Id, shared with the writer
+        self.seq = 0
+
+    def __getattr__(self, name: str):
+        # at_eof(), exception() etc. of the underlying reader
+        return getattr(self._reader, name)
+
+    async def readexactly(self, n: int) -> bytes:
+        while len(self._buf) < n:
+            header = await self._reader.readexactly(7)
+            length = int.from_bytes(header[0:3], 'little')
+            uncompressed = int.from_bytes(header[4:7], 'little')
+            payload = await self._reader.readexactly(length)
+            if uncompressed:
+                payload = zlib.decompress(payload)
+                add_bytes_saved(uncompressed - length)
+            self._buf += payload
+            self.seq = (header[3] + 1) & 0xff
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+
+class _CompressedWriter:
+    def __init__(self, writer, reader: _CompressedReader):
+        self._writer = writer
+        self._reader = reader
+
+    def __getattr__(self, name: str):
+        # transport, drain() etc. of the underlying writer
+        return getattr(self._writer, name)
+
+    def write(self, data: bytes):
+        # aiomysql writes one packet at a time; a packet with sequence Id 0
+        # starts a new command, which also resets the compressed sequence
+        if data[3] == 0:
+            self._reader.seq = 0
+        if len(data) < MIN_COMPRESS_LENGTH:
+            payload, uncompressed = data, 0
+        else:
+            payload, uncompressed = zlib.compress(data), len(data)
+        self._writer.write(
+            struct.pack('<I', len(payload))[:3] +
+            bytes((self._reader.seq,)) +
+            struct.pack('<I', uncompressed)[:3] + payload)
+        self._reader.seq = (self._reader.seq + 1) & 0xff
+
+
+def enable_compression(conn):
+    """Switch an authenticated connection to the compressed protocol; Must be
+    called before the first command on the connection."""
+    if isinstance(conn._reader, _CompressedReader):
+        return
+    count_bytes_received(conn)
+    conn._reader = _CompressedReader(conn._reader)
+    conn._writer = _CompressedWriter(conn._writer, conn._reader)
+
+
+# Largest number of bytes received in the last run per check, by asset Id
+_received: Dict[int, Dict[str, int]] = {}
+
+
+def use_compression(asset_id: int, compress) -> bool:
+    if compress != COMPRESS_AUTO:
+        return bool(compress)
+    received = _received.get(asset_id)
+    return received is not None and max(received.values()) > \
+        COMPRESS_THRESHOLD
+
+
+def record_received(asset_id: int, check_key: str):
+    # Uncompressed size of the responses in the current check run
+    n = received_bytes()
+    if n:
+        _received.setdefault(asset_id, {})[check_key] = n
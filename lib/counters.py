@@ -0,0 +1,70 @@
+"""Per-asset state of monotonic counters, used to derive per-second rates
+from the previous sample within the probe.
+
+Each store holds one fixed set of counter names; a sample for an asset is an
+array of doubles in the order of these names, so memory is 8 bytes per
+counter per asset plus a small fixed overhead.
+"""
+import math
+import time
+from array import array
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+
+_MISSING = math.nan
+
+
+class _Sample:
+    __slots__ = ('ts', 'uptime', 'values')
+
+    def __init__(self, ts: float, uptime: Optional[int], values: array):
+        self.ts = ts
+        self.uptime = uptime
+        self.values = values
+
+
+class CounterStore:
+    __slots__ = ('_names', '_samples')
+
+    def __init__(self, names: Iterable[str]):
+        self._names = tuple(names)
+        self._samples: Dict[int, _Sample] = {}
+
+    def rates(
+            self,
+            asset_id: int,
+            sample: Mapping[str, Any],
+            uptime: Optional[int] = None,
+            now: Optional[float] = None) -> Dict[str, float]:
+        """Store the sample and return the per-second rate for each counter
+        compared to the previous sample of the asset.
+
+        No rates are returned for the first sample, after a server restart
+        (uptime went backwards) and for counters which are missing in either
+        sample or have decreased (wrapped, or reset by FLUSH STATUS).
+        """
+        if now is None:
+            now = time.monotonic()
+
+        values = array('d', (
+            float(sample[name]) if name in sample else _MISSING
+            for name in self._names))
+        prev = self._samples.get(asset_id)
+        self._samples[asset_id] = _Sample(now, uptime, values)
+
+        if prev is None or (
+                uptime is not None and
+                prev.uptime is not None and
+                uptime < prev.uptime):
+            return {}
+
+        elapsed = now - prev.ts
+        if elapsed <= 0.0:
+            return {}
+
+        rates = {}
+        for name, cur, old in zip(self._names, values, prev.values):
+            # NaN compares false, thus missing values are skipped as well
+            if cur >= old:
+                rates[name] = (cur - old) / elapsed
+        return rates
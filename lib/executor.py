@@ -0,0 +1,76 @@
+"""Run CPU-bound work (like parsing a large InnoDB status) outside the event
+loop so a single large asset does not delay the I/O of all other checks.
+
+PARSE_EXECUTOR selects the mode:
+  `none`:     always run inline, on the event loop
+  `thread`:   use a thread pool; frees the loop, but work still holds the GIL
+  `process`:  use a process pool; true parallelism at the cost of copying
+              the input and result between processes
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+
+
+PARSE_EXECUTOR = os.getenv('PARSE_EXECUTOR', 'thread').lower()
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 0)) or os.cpu_count() or 1
+# Input smaller than this number of bytes is always processed inline as the
+# overhead of the executor is larger than the time it saves
+PARSE_THRESHOLD = int(os.getenv('PARSE_THRESHOLD', 65536))
+
+if PARSE_EXECUTOR not in ('none', 'thread', 'process'):
+    logging.warning(
+        f'invalid PARSE_EXECUTOR `{PARSE_EXECUTOR}`, falling back to `none`')
+    PARSE_EXECUTOR = 'none'
+
+_executor: Optional[Executor] = None
+
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if PARSE_EXECUTOR == 'process':
+            _executor = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+        else:
+            _executor = ThreadPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                thread_name_prefix='parse')
+    return _executor
+
+
+def _timed(func: Callable[[Any], Any], arg: Any) -> Tuple[Any, float, float]:
+    # time.monotonic() is system wide on Linux, thus comparable between the
+    # probe and the worker processes
+    start = time.monotonic()
+    res = func(arg)
+    return res, start, time.monotonic()
+
+
+async def run_parser(
+        func: Callable[[Any], Any],
+        arg: Any,
+        size: int) -> Tuple[Any, dict]:
+    """Returns the result of func(arg) together with metrics for the `probe`
+    item; when using a process pool, both func and arg must be picklable."""
+    queued = time.monotonic()
+    if PARSE_EXECUTOR == 'none' or size < PARSE_THRESHOLD:
+        res, start, end = _timed(func, arg)
+        offloaded = False
+    else:
+        loop = asyncio.get_running_loop()
+        res, start, end = await loop.run_in_executor(
+            _get_executor(), _timed, func, arg)
+        offloaded = True
+
+    return res, {
+        'parse_offloaded': offloaded,
+        'parse_queue_wait': max(start - queued, 0.0),
+        'parse_time': end - start,
+    }
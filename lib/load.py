@@ -0,0 +1,53 @@
+"""Load signals per asset, used to choose a lighter collection tier on busy
+servers.
+
+The signals are taken from samples the checks already collect (no extra
+queries); `Threads_running` from the `mysql` check, `queries_queued` and
+`semaphore_waits` from the InnoDB status. A signal is only used for
+LOAD_SIGNAL_TTL seconds; when the InnoDB status is no longer read because of
+the load, its signals expire and the full tier is tried again.
+"""
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+
+TIER_FULL = 'full'
+TIER_LIGHT = 'light'
+
+# Thresholds; a value of 0 disables the signal
+LOAD_THRESHOLDS = {
+    'threads_running': int(os.getenv('LOAD_THREADS_RUNNING', 64)),
+    'queries_queued': int(os.getenv('LOAD_QUERIES_QUEUED', 10)),
+    'semaphore_waits': int(os.getenv('LOAD_SEMAPHORE_WAITS', 10)),
+}
+LOAD_SIGNAL_TTL = float(os.getenv('LOAD_SIGNAL_TTL', 300))
+
+# Signal name: (value, timestamp) per asset Id
+_signals: Dict[int, Dict[str, Tuple[float, float]]] = {}
+
+
+def record_load(asset_id: int, **signals: Optional[float]):
+    now = time.monotonic()
+    asset_signals = _signals.get(asset_id)
+    if asset_signals is None:
+        asset_signals = _signals[asset_id] = {}
+    for name, value in signals.items():
+        if value is not None:
+            asset_signals[name] = (value, now)
+
+
+def load_tier(asset_id: int) -> Tuple[str, Optional[str]]:
+    """Returns the collection tier and, for the light tier, the reason."""
+    asset_signals = _signals.get(asset_id)
+    if not asset_signals:
+        return TIER_FULL, None
+    now = time.monotonic()
+    for name, threshold in LOAD_THRESHOLDS.items():
+        signal = asset_signals.get(name)
+        if signal is None or not threshold:
+            continue
+        value, ts = signal
+        if now - ts <= LOAD_SIGNAL_TTL and value >= threshold:
+            return TIER_LIGHT, f'{name}={value:g}'
+    return TIER_FULL, None
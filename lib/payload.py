@@ -0,0 +1,119 @@
+"""Compact payloads, enabled with `payload: "delta"` in the check config.
+
+Metrics which do not exist on the flavour and version of the server are
+dropped, and a metric is only sent when its value has changed since it was
+last sent. All metrics are sent (a keyframe) every PAYLOAD_KEYFRAME seconds,
+when the server capabilities have changed and for an item when its set of
+metrics has changed, for example after a restart.
+
+The values last sent are kept as a sorted array of 64-bit hashes of
+(metric, value) per item, thus 8 bytes per metric.
+"""
+import os
+import time
+from array import array
+from bisect import bisect_left
+from typing import Any, Dict, Tuple
+from .capabilities import FLAVOUR_MARIADB, FLAVOUR_MYSQL, FLAVOUR_PERCONA, \
+    Capabilities
+
+
+PAYLOAD_FULL = 'full'
+PAYLOAD_DELTA = 'delta'
+
+PAYLOAD_KEYFRAME = float(os.getenv('PAYLOAD_KEYFRAME', 900))
+
+# (flavours, as of version, item type, metric prefixes) for metrics which do
+# not exist on the server
+_UNAVAILABLE = (
+    # The query cache has been removed in MySQL 8.0
+    ((FLAVOUR_MYSQL, FLAVOUR_PERCONA), (8, 0, 0),
+     'status', ('qcache_',)),
+    ((FLAVOUR_MYSQL, FLAVOUR_PERCONA), (8, 0, 0),
+     'variables', ('query_cache_size',)),
+    # The additional memory pool has been removed in MySQL 5.7
+    ((FLAVOUR_MYSQL, FLAVOUR_PERCONA), (5, 7, 0),
+     'innodb', ('mem_additional_pool',)),
+    # The change buffer has been removed in MariaDB 11.0
+    ((FLAVOUR_MARIADB,), (11, 0, 0),
+     'innodb', ('ibuf_', 'pending_ibuf_aio_reads')),
+)
+
+
+class _Sent:
+    __slots__ = ('caps', 'keyframe_at', 'items')
+
+    def __init__(self, caps: Capabilities, keyframe_at: float):
+        self.caps = caps
+        self.keyframe_at = keyframe_at
+        # (hash of the metric names, sorted hashes of (metric, value)) per
+        # (item type, item name)
+        self.items: Dict[Tuple[str, str], Tuple[int, array]] = {}
+
+
+# Values last sent per check and asset Id
+_sent: Dict[Tuple[str, int], _Sent] = {}
+
+
+def _unavailable(caps: Capabilities) -> Dict[str, Tuple[str, ...]]:
+    prefixes: Dict[str, Tuple[str, ...]] = {}
+    for flavours, version, type_name, names in _UNAVAILABLE:
+        if caps.flavour in flavours and caps.version >= version:
+            prefixes[type_name] = prefixes.get(type_name, ()) + names
+    return prefixes
+
+
+def _contains(hashes: array, h: int) -> bool:
+    idx = bisect_left(hashes, h)
+    return idx < len(hashes) and hashes[idx] == h
+
+
+def compact_result(
+        check_key: str,
+        asset_id: int,
+        caps: Capabilities,
+        result: dict) -> Dict[str, Any]:
+    """Compact the items in the result (in place) and return the fields for
+    the probe item."""
+    now = time.monotonic()
+    sent = _sent.get((check_key, asset_id))
+    is_keyframe = sent is None or sent.caps is not caps or \
+        now >= sent.keyframe_at
+    if sent is None or is_keyframe:
+        sent = _sent[(check_key, asset_id)] = \
+            _Sent(caps, now + PAYLOAD_KEYFRAME)
+
+    unavailable = _unavailable(caps)
+    dropped = 0
+    for type_name, items in result.items():
+        if type_name == 'probe':
+            continue
+        prefixes = unavailable.get(type_name, ())
+        for idx, item in enumerate(items):
+            if prefixes:
+                for key in [k for k in item if k.startswith(prefixes)]:
+                    del item[key]
+                    dropped += 1
+
+            # The name is not a metric and is always sent
+            metrics = [(k, v) for k, v in item.items() if k != 'name']
+            names_hash = hash(tuple(sorted(k for k, _ in metrics)))
+            hashes = array('q', sorted(hash(m) for m in metrics))
+            item_key = (type_name, item['name'])
+            prev = sent.items.get(item_key)
+            sent.items[item_key] = names_hash, hashes
+            if is_keyframe or prev is None or prev[0] != names_hash:
+                continue
+
+            changed = {'name': item['name']}
+            for metric in metrics:
+                if _contains(prev[1], hash(metric)):
+                    dropped += 1
+                else:
+                    changed[metric[0]] = metric[1]
+            items[idx] = changed
+
+    return {
+        'payload': 'keyframe' if is_keyframe else PAYLOAD_DELTA,
+        'payload_metrics_dropped': dropped,
+    }
@@ -0,0 +1,196 @@
+"""Long-lived MySQL connection pools, shared by all checks.
+
+Pools are keyed by (address, port, username) and the transport options
+(Unix socket and compression) so the checks for an asset re-use the same
+connections instead of connecting (and thus bumping `Connections`) on every
+run.
+"""
+import aiomysql
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from libprobe.exceptions import CheckException
+from pymysql.constants import CLIENT, CR
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from .compress import enable_compression
+from .timing import count_bytes_received, phase
+
+
+# Maximum number of connections per pool (thus per address/port/username)
+POOL_MAX_SIZE = int(os.getenv('POOL_MAX_SIZE', 2))
+# Connections (and pools) which are idle for longer than this number of
+# seconds are closed; Must be larger than the check interval to be useful
+POOL_IDLE_TIMEOUT = float(os.getenv('POOL_IDLE_TIMEOUT', 900))
+# Timeout in seconds for setting up a new connection and for the ping which
+# checks a pooled connection before re-use
+CONNECT_TIMEOUT = float(os.getenv('CONNECT_TIMEOUT', 10))
+
+SWEEP_INTERVAL = 60.0
+
+PoolKey = Tuple[str, int, str, Optional[str], bool]
+
+# Client errors for a server which cannot be reached (as opposed to, for
+# example, access denied or too many connections)
+_UNREACHABLE = frozenset((
+    CR.CR_CONNECTION_ERROR,
+    CR.CR_CONN_HOST_ERROR,
+    CR.CR_UNKNOWN_HOST,
+    CR.CR_SERVER_GONE_ERROR,
+    CR.CR_SERVER_LOST,
+))
+
+
+class ConnectError(CheckException):
+    # Raised when the server cannot be reached; other errors while setting up
+    # a connection are raised as CheckException
+    pass
+
+
+def _is_unreachable(e: Exception) -> bool:
+    if isinstance(e, (asyncio.TimeoutError, OSError)):
+        return True
+    return isinstance(e, aiomysql.OperationalError) and \
+        bool(e.args) and e.args[0] in _UNREACHABLE
+
+
+class _PoolEntry:
+    __slots__ = ('pool', 'password', 'last_used')
+
+    def __init__(self, pool: aiomysql.Pool, password: str):
+        self.pool = pool
+        self.password = password
+        self.last_used = time.monotonic()
+
+
+_pools: Dict[PoolKey, _PoolEntry] = {}
+_next_sweep = 0.0
+
+
+async def _close_pool(pool: aiomysql.Pool):
+    # Free connections are closed now, connections in use are closed as soon
+    # as they are released
+    pool.close()
+    await pool.clear()
+
+
+async def _sweep(now: float):
+    global _next_sweep
+    if now < _next_sweep:
+        return
+    _next_sweep = now + SWEEP_INTERVAL
+
+    stale: List[aiomysql.Pool] = []
+    for key, entry in list(_pools.items()):
+        pool = entry.pool
+        if now - entry.last_used > POOL_IDLE_TIMEOUT and \
+                pool.size == pool.freesize:
+            del _pools[key]
+            stale.append(pool)
+
+    for pool in stale:
+        await _close_pool(pool)
+
+
+def _get_pool(
+        key: PoolKey,
+        password: str) -> Tuple[_PoolEntry, List[aiomysql.Pool]]:
+    # No await in this function; Concurrent checks for the same key must end
+    # up with the same pool
+    stale = []
+    entry = _pools.get(key)
+    if entry is not None and entry.password != password:
+        # Credentials in the asset config have changed
+        del _pools[key]
+        stale.append(entry.pool)
+        entry = None
+
+    if entry is None:
+        address, port, username, unix_socket, compress = key
+        kwargs: Dict[str, Any] = {}
+        if compress:
+            # Nothing may be sent before the switch to the compressed
+            # protocol in _acquire_healthy(), thus autocommit is not set
+            kwargs['client_flag'] = CLIENT.COMPRESS
+            kwargs['autocommit'] = None
+        pool = aiomysql.Pool(
+            minsize=0,
+            maxsize=POOL_MAX_SIZE,
+            echo=False,
+            pool_recycle=POOL_IDLE_TIMEOUT,
+            connect_timeout=CONNECT_TIMEOUT,
+            loop=asyncio.get_running_loop(),
+            host=address,
+            port=port,
+            unix_socket=unix_socket,
+            user=username,
+            password=password,
+            **kwargs,
+        )
+        entry = _pools[key] = _PoolEntry(pool, password)
+
+    return entry, stale
+
+
+async def _acquire(
+        pool: aiomysql.Pool,
+        compress: bool) -> aiomysql.Connection:
+    conn = await pool.acquire()
+    if compress and conn.server_capabilities & CLIENT.COMPRESS:
+        enable_compression(conn)
+    return conn
+
+
+async def _acquire_healthy(
+        pool: aiomysql.Pool,
+        compress: bool) -> aiomysql.Connection:
+    # Each attempt either returns or discards a connection so the loop ends
+    # with a fresh connection at the latest after POOL_MAX_SIZE attempts
+    for _ in range(POOL_MAX_SIZE):
+        conn = await _acquire(pool, compress)
+        try:
+            await asyncio.wait_for(
+                conn.ping(reconnect=False), CONNECT_TIMEOUT)
+        except Exception:
+            conn.close()
+            pool.release(conn)
+        else:
+            return conn
+    return await _acquire(pool, compress)
+
+
+@asynccontextmanager
+async def acquire(
+        address: str,
+        port: int,
+        username: str,
+        password: str,
+        unix_socket: Optional[str] = None,
+        compress: bool = False) -> AsyncIterator[aiomysql.Connection]:
+    now = time.monotonic()
+    await _sweep(now)
+
+    entry, stale = _get_pool(
+        (address, port, username, unix_socket, compress), password)
+    entry.last_used = now
+    for pool in stale:
+        await _close_pool(pool)
+
+    try:
+        with phase('connect'):
+            conn = await _acquire_healthy(entry.pool, compress)
+    except Exception as e:
+        error_msg = str(e) or type(e).__name__
+        if _is_unreachable(e):
+            raise ConnectError(f'unable to connect: {error_msg}')
+        raise CheckException(f'unable to connect: {error_msg}')
+    count_bytes_received(conn)
+
+    try:
+        yield conn
+    except BaseException:
+        # The state of the connection is unknown; do not hand it out again
+        conn.close()
+        raise
+    finally:
+        entry.pool.release(conn)
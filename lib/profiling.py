@@ -0,0 +1,151 @@
+"""Opt-in profiling of check runs, enabled with the PROFILE environment
+variable. When disabled, the check functions are not wrapped at all.
+
+PROFILE:
+  `cprofile`:  deterministic profile, written as `.prof` (pstats) file;
+               the profiler sees all code on the event loop, not only the
+               profiled check
+  `sample`:    samples the event loop thread PROFILE_RATE times per second
+               and keeps only the stacks which run the profiled check;
+               written as `.folded` file (collapsed stacks, for flame graphs)
+
+PROFILE_TRACEMALLOC=1 writes a tracemalloc snapshot after each profiled run
+(this may be used with or without PROFILE).
+"""
+import cProfile
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from libprobe.asset import Asset
+from typing import Any, Callable, Coroutine, Dict
+
+
+PROFILE = os.getenv('PROFILE', '').lower()
+PROFILE_RATE = float(os.getenv('PROFILE_RATE', 100))
+PROFILE_TRACEMALLOC = os.getenv('PROFILE_TRACEMALLOC', '0') == '1'
+# Comma separated asset Id's or names; when empty, all assets are profiled
+PROFILE_ASSETS = frozenset(
+    name.strip()
+    for name in os.getenv('PROFILE_ASSETS', '').split(',')
+    if name.strip())
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/data/profiles')
+# Maximum number of dump files kept per check and asset
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 10))
+
+CheckFun = Callable[[Asset, dict, dict], Coroutine[Any, Any, dict]]
+
+# Only one cProfile profiler can be active at a time
+_cprofile_active = False
+
+
+def _is_enabled() -> bool:
+    return PROFILE in ('cprofile', 'sample') or PROFILE_TRACEMALLOC
+
+
+def _is_selected(asset: Asset) -> bool:
+    return not PROFILE_ASSETS or \
+        str(asset.id) in PROFILE_ASSETS or \
+        asset.name in PROFILE_ASSETS
+
+
+def _dump_path(check_key: str, asset: Asset, ext: str) -> str:
+    prefix = f'{check_key}-{asset.id}-'
+    # Rotate; remove the oldest files so at most PROFILE_KEEP remain
+    existing = sorted(
+        fn for fn in os.listdir(PROFILE_DIR)
+        if fn.startswith(prefix) and fn.endswith(ext))
+    for fn in existing[:max(len(existing) - PROFILE_KEEP + 1, 0)]:
+        os.remove(os.path.join(PROFILE_DIR, fn))
+    return os.path.join(
+        PROFILE_DIR, f'{prefix}{time.strftime("%Y%m%d%H%M%S")}{ext}')
+
+
+class _Sampler(threading.Thread):
+
+    def __init__(self, thread_id: int, frame):
+        super().__init__(daemon=True)
+        self._thread_id = thread_id
+        self._frame = frame
+        self._done = threading.Event()
+        self.stacks: Counter = Counter()
+
+    def run(self):
+        interval = 1.0 / PROFILE_RATE
+        while not self._done.wait(interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            found = False
+            while frame is not None:
+                # Other runs of the same check (other assets) share the code
+                # object but not the frame of the check coroutine
+                found = found or frame is self._frame
+                code = frame.f_code
+                stack.append(
+                    f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            if found:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _profiled(check_key: str, fun: CheckFun) -> CheckFun:
+
+    @functools.wraps(fun)
+    async def wrapper(asset: Asset, asset_config: dict, config: dict) -> dict:
+        global _cprofile_active
+        if not _is_selected(asset):
+            return await fun(asset, asset_config, config)
+
+        coro = fun(asset, asset_config, config)
+        profiler = sampler = None
+        if PROFILE == 'cprofile' and not _cprofile_active:
+            _cprofile_active = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif PROFILE == 'sample':
+            sampler = _Sampler(
+                threading.get_ident(), getattr(coro, 'cr_frame', None))
+            sampler.start()
+
+        try:
+            return await coro
+        finally:
+            try:
+                if profiler is not None:
+                    profiler.disable()
+                    _cprofile_active = False
+                    profiler.dump_stats(_dump_path(check_key, asset, '.prof'))
+                if sampler is not None:
+                    sampler.stop()
+                    path = _dump_path(check_key, asset, '.folded')
+                    with open(path, 'w') as fp:
+                        for stack, n in sampler.stacks.items():
+                            fp.write(f'{stack} {n}\n')
+                if PROFILE_TRACEMALLOC:
+                    tracemalloc.take_snapshot().dump(
+                        _dump_path(check_key, asset, '.tracemalloc'))
+            except Exception as e:
+                logging.error(f'failed to write profile: {e}; {asset}')
+
+    return wrapper
+
+
+def profile_checks(checks: Dict[str, CheckFun]) -> Dict[str, CheckFun]:
+    if not _is_enabled():
+        return checks
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if PROFILE_TRACEMALLOC:
+        tracemalloc.start()
+    logging.warning(f'profiling enabled ({PROFILE or "tracemalloc"})')
+    return {
+        check_key: _profiled(check_key, fun)
+        for check_key, fun in checks.items()}
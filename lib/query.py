@@ -1,23 +1,157 @@
 import aiomysql
+import asyncio
+import collections
 import datetime
-import decimal
+import functools
 import logging
+import os
+from contextlib import asynccontextmanager
 from libprobe.asset import Asset
 from libprobe.exceptions import CheckException
+from pymysql.constants import ER, FIELD_TYPE
+from libprobe.probe import MAX_CHECK_TIMEOUT
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, \
+    Iterator, Set, Tuple, TypeVar
 from . import DOCS_URL
+from .breaker import breaker_check, breaker_failure, breaker_success
+from .compress import record_received, use_compression
+from .pool import CONNECT_TIMEOUT, ConnectError, acquire
+from .scheduler import connections
+from .timing import add_rows, phase
 
 
 DEFAULT_MYSQL_PORT = 3306
 
+# Timeout in seconds for a single query (or a batch of queries sent in one
+# round trip); on expiry the query is killed on the server and the connection
+# is discarded. Lowered per check to end before the check timeout
+QUERY_TIMEOUT = float(os.getenv('QUERY_TIMEOUT', 60))
 
+T = TypeVar('T')
+
+# Server errors for a table, column or variable which does not exist, or which
+# the user may not read; Other errors (for example a lost connection or a
+# timeout) are transient
+_UNAVAILABLE = frozenset((
+    ER.NO_SUCH_TABLE,
+    ER.UNKNOWN_TABLE,
+    ER.BAD_FIELD_ERROR,
+    ER.UNKNOWN_SYSTEM_VARIABLE,
+    ER.DBACCESS_DENIED_ERROR,
+    ER.TABLEACCESS_DENIED_ERROR,
+    ER.COLUMNACCESS_DENIED_ERROR,
+    ER.SPECIFIC_ACCESS_DENIED_ERROR,
+))
+
+
+class UnavailableError(CheckException):
+    # Raised when the server lacks what the query reads (or the user may not
+    # read it); This will not change until the server is upgraded or
+    # reconfigured
+    pass
+
+
+# Killed queries of cancelled checks; a reference is kept until done
+_kills: Set[asyncio.Task] = set()
+
+
+def _timeouts(config: dict) -> Tuple[float, float]:
+    # Returns the timeout for a query and for each of the two steps of
+    # killing it (connect and KILL QUERY); libprobe cancels a check after
+    # min(0.8 * interval, MAX_CHECK_TIMEOUT) seconds, thus a query must time
+    # out and be killed before that
+    interval = config.get('_interval')
+    if not interval:
+        return QUERY_TIMEOUT, CONNECT_TIMEOUT
+    check_timeout = min(0.8 * interval, MAX_CHECK_TIMEOUT)
+    kill_timeout = min(CONNECT_TIMEOUT, 0.1 * check_timeout)
+    return min(QUERY_TIMEOUT, check_timeout - 3 * kill_timeout), kill_timeout
+
+
+async def _set_max_execution_time(conn: aiomysql.Connection):
+    # Let the server abort slow queries as well (when the timeout of the
+    # check differs from the previous check on this connection);
+    # `max_execution_time` (MySQL 5.7.8+, SELECT statements only) or
+    # `max_statement_time` (MariaDB 10.1+, also SHOW statements)
+    query_timeout = getattr(conn, 'query_timeout', QUERY_TIMEOUT)
+    if getattr(conn, 'max_execution_time_set', None) == query_timeout:
+        return
+    for statement in (
+            'SET SESSION max_execution_time = '
+            f'{int(query_timeout * 1000)}',
+            f'SET SESSION max_statement_time = {query_timeout}'):
+        try:
+            async with conn.cursor() as cursor:
+                await _timeout(conn, cursor.execute(statement))
+        except aiomysql.OperationalError:
+            continue  # unknown system variable
+        break
+    setattr(conn, 'max_execution_time_set', query_timeout)
+
+
+async def _kill_query(conn: aiomysql.Connection):
+    # The connection itself is still waiting for the result, thus the query
+    # is killed using a separate connection
+    thread_id = conn.thread_id()
+    kill_timeout = getattr(conn, 'kill_timeout', CONNECT_TIMEOUT)
+    try:
+        side_conn = await asyncio.wait_for(aiomysql.connect(
+            host=conn.host,
+            port=conn.port,
+            unix_socket=conn.unix_socket,
+            user=conn.user,
+            password=conn._password,
+            connect_timeout=kill_timeout,
+        ), kill_timeout)
+        try:
+            async with side_conn.cursor() as cursor:
+                await asyncio.wait_for(
+                    cursor.execute(f'KILL QUERY {thread_id}'),
+                    kill_timeout)
+        finally:
+            side_conn.close()
+    except Exception as e:
+        error_msg = str(e) or type(e).__name__
+        logging.warning(f'failed to kill query: {error_msg}')
+
+
+async def _timeout(conn: aiomysql.Connection, aw: Awaitable[T]) -> T:
+    query_timeout = getattr(conn, 'query_timeout', QUERY_TIMEOUT)
+    try:
+        return await asyncio.wait_for(aw, query_timeout)
+    except asyncio.TimeoutError:
+        await _kill_query(conn)
+        # The socket is in an unknown state; close it (the pool will not hand
+        # out the connection again) and make sure the cursor does not try to
+        # read the remaining result
+        conn.close()
+        conn._result = None
+        raise CheckException(
+            f'query timed out after {query_timeout:.1f} seconds')
+    except asyncio.CancelledError:
+        # The check is cancelled (check timeout); the query is killed in the
+        # background so the cancellation is not delayed
+        task = asyncio.ensure_future(_kill_query(conn))
+        _kills.add(task)
+        task.add_done_callback(_kills.discard)
+        conn.close()
+        conn._result = None
+        raise
+
+
+@asynccontextmanager
 async def get_conn(
         asset: Asset,
         asset_config: dict,
-        config: dict) -> aiomysql.Connection:
+        config: dict) -> AsyncIterator[aiomysql.Connection]:
     address = config.get('address')
     if not address:
         address = asset.name
     port = config.get('port', DEFAULT_MYSQL_PORT)
+    unix_socket = config.get('socket') or None
+    # Compression is of no use over a Unix socket
+    compress = unix_socket is None and \
+        use_compression(asset.id, config.get('compress', False))
     username = asset_config.get('username')
     password = asset_config.get('password')
     if username is None or password is None:
@@ -26,55 +160,223 @@ async def get_conn(
             f' for detailed instructions: <{DOCS_URL}>'
         )
 
-    try:
-        conn = await aiomysql.connect(
-            host=address,
-            port=port,
-            user=username,
-            password=password,
-        )
-    except Exception as e:
-        error_msg = str(e) or type(e).__name__
-        raise CheckException(f'unable to connect: {error_msg}')
-    return conn
+    breaker_check(asset.id)
+    query_timeout, kill_timeout = _timeouts(config)
+    async with connections.slot(address):
+        try:
+            async with acquire(
+                    address, port, username, password, unix_socket,
+                    compress) as conn:
+                breaker_success(asset.id)
+                setattr(conn, 'query_timeout', query_timeout)
+                setattr(conn, 'kill_timeout', kill_timeout)
+                try:
+                    await _set_max_execution_time(conn)
+                except Exception as e:
+                    error_msg = str(e) or type(e).__name__
+                    raise CheckException(
+                        f'unable to set up connection: {error_msg}')
+                yield conn
+                record_received(asset.id, asset.check)
+        except ConnectError as e:
+            # Only a server which cannot be reached counts for the circuit
+            # breaker; for example access denied fails fast anyway and may
+            # be fixed by the next run with new credentials
+            breaker_failure(asset.id, str(e))
+            raise
+        except CheckException:
+            # The server has been reached
+            breaker_success(asset.id)
+            raise
+
+
+def in_list(names: Iterable[str]) -> str:
+    # Only for names defined in the probe itself, values are not escaped
+    return ', '.join(f"'{name}'" for name in names)
+
+
+def _datetime(value):
+    # Invalid dates like 0000-00-00 are returned as string
+    return value.timestamp() \
+        if isinstance(value, datetime.datetime) else value
+
+
+def _timedelta(value):
+    # TIME values range from -838:59:59 to 838:59:59; `seconds` would drop
+    # the days and wrap negative values
+    return int(value.total_seconds()) \
+        if isinstance(value, datetime.timedelta) else value
+
+
+# Converters by column type code; Columns of other types are not converted
+CONVERTERS: Dict[int, Callable[[Any], Any]] = {
+    FIELD_TYPE.DECIMAL: float,
+    FIELD_TYPE.NEWDECIMAL: float,
+    FIELD_TYPE.DATETIME: _datetime,
+    FIELD_TYPE.TIMESTAMP: _datetime,
+    FIELD_TYPE.TIME: _timedelta,
+}
+
+
+def _converters(
+        description: tuple) -> Tuple[Tuple[int, Callable[[Any], Any]], ...]:
+    # Converters are chosen once per result set, not per value
+    return tuple(
+        (idx, CONVERTERS[type_code])
+        for idx, (_, type_code, *_) in enumerate(description)
+        if type_code in CONVERTERS)
 
 
-async def query(conn: aiomysql.Connection, query: str) -> list:
-    items = []
+def _convert(description: tuple, rows: tuple) -> Iterator[tuple]:
+    converters = _converters(description)
+    if not converters:
+        yield from rows
+        return
+    for row in rows:
+        row = list(row)
+        for idx, converter in converters:
+            value = row[idx]
+            if value is not None:
+                row[idx] = converter(value)
+        yield tuple(row)
+
+
+@functools.lru_cache(maxsize=256)
+def _record_type(names: Tuple[str, ...]) -> type:
+    # A named tuple has no per-instance __dict__, thus the same memory
+    # footprint as a plain tuple
+    return collections.namedtuple('Record', names, rename=True)
+
+
+def _to_items(description: tuple, rows: tuple) -> list:
+    names = tuple(name for name, *_ in description)
+    return [dict(zip(names, row)) for row in _convert(description, rows)]
+
+
+def _to_records(description: tuple, rows: tuple) -> list:
+    record = _record_type(tuple(name for name, *_ in description))
+    return [record._make(row) for row in _convert(description, rows)]
+
+
+def _query_error(e: Exception) -> CheckException:
+    error_msg = str(e) or type(e).__name__
+    logging.exception(f'query error: {error_msg};')
+    if isinstance(e, aiomysql.MySQLError) and e.args and \
+            e.args[0] in _UNAVAILABLE:
+        return UnavailableError(error_msg)
+    return CheckException(error_msg)
+
+
+async def _fetchall(cursor: aiomysql.Cursor, query: str) -> tuple:
+    await cursor.execute(query)
+    return await cursor.fetchall()
+
+
+async def query(
+        conn: aiomysql.Connection,
+        query: str,
+        as_records: bool = False) -> list:
+    # With `as_records`, rows are returned as named tuples instead of dicts
+    to_items = _to_records if as_records else _to_items
     try:
         async with conn.cursor() as cursor:
-            await cursor.execute(query)
-            rows = await cursor.fetchall()
-            for row in rows:
-                item = {}
-                for (name, *_), value in zip(cursor.description, row):
-                    if isinstance(value, decimal.Decimal):
-                        item[name] = float(value)
-                    elif isinstance(value, datetime.datetime):
-                        row[name] = value.timestamp()
-                    elif isinstance(value, datetime.timedelta):
-                        row[name] = value.seconds
-                    else:
-                        item[name] = value
-                items.append(item)
+            with phase('query'):
+                rows = await _timeout(conn, _fetchall(cursor, query))
+            with phase('convert'):
+                items = to_items(cursor.description, rows)
+            add_rows(len(rows))
 
     except Exception as e:
-        error_msg = str(e) or type(e).__name__
-        logging.exception(f'query error: {error_msg};')
-        raise CheckException(error_msg)
+        raise _query_error(e)
 
     return items
 
 
+async def query_stream(
+        conn: aiomysql.Connection,
+        query: str,
+        batch_size: int = 1000,
+        as_records: bool = False) -> AsyncIterator[list]:
+    # Rows are read from the server while iterating (unbuffered) and yielded
+    # as converted batches of at most `batch_size` rows, so memory does not
+    # grow with the size of the result set.
+    # The connection is busy until the generator is exhausted or closed; use
+    # `async with contextlib.aclosing(query_stream(...)) as batches:` when
+    # the loop might stop early.
+    to_items = _to_records if as_records else _to_items
+    try:
+        async with conn.cursor(aiomysql.SSCursor) as cursor:
+            with phase('query'):
+                await _timeout(conn, cursor.execute(query))
+            description = cursor.description
+            while True:
+                with phase('query'):
+                    rows = await _timeout(conn, cursor.fetchmany(batch_size))
+                if not rows:
+                    break
+                with phase('convert'):
+                    items = to_items(description, rows)
+                add_rows(len(rows))
+                yield items
+
+    except Exception as e:
+        raise _query_error(e)
+
+
 async def query_flat(conn: aiomysql.Connection, query: str) -> dict:
     try:
         async with conn.cursor() as cursor:
-            await cursor.execute(query)
-            item = dict(await cursor.fetchall())
+            with phase('query'):
+                rows = await _timeout(conn, _fetchall(cursor, query))
+            with phase('convert'):
+                item = dict(rows)
+            add_rows(len(rows))
 
     except Exception as e:
-        error_msg = str(e) or type(e).__name__
-        logging.exception(f'query error: {error_msg};')
-        raise CheckException(error_msg)
+        raise _query_error(e)
     else:
         return item
+
+
+async def _execute_multi(
+        conn: aiomysql.Connection,
+        queries: Dict[str, str]) -> Dict[str, Tuple[tuple, tuple]]:
+    # All statements are sent in a single round trip; the server returns one
+    # result set per statement, in order
+    results = {}
+
+    async def fetch(cursor: aiomysql.Cursor):
+        await cursor.execute(';\n'.join(queries.values()))
+        for name in queries:
+            rows = await cursor.fetchall()
+            results[name] = (cursor.description, rows)
+            add_rows(len(rows))
+            await cursor.nextset()
+
+    try:
+        async with conn.cursor() as cursor:
+            with phase('query'):
+                await _timeout(conn, fetch(cursor))
+
+    except Exception as e:
+        raise _query_error(e)
+
+    return results
+
+
+async def query_multi(
+        conn: aiomysql.Connection,
+        queries: Dict[str, str]) -> Dict[str, list]:
+    results = await _execute_multi(conn, queries)
+    with phase('convert'):
+        return {
+            name: _to_items(description, rows)
+            for name, (description, rows) in results.items()}
+
+
+async def query_multi_flat(
+        conn: aiomysql.Connection,
+        queries: Dict[str, str]) -> Dict[str, dict]:
+    results = await _execute_multi(conn, queries)
+    with phase('convert'):
+        return {name: dict(rows) for name, (_, rows) in results.items()}
@@ -0,0 +1,126 @@
+"""Limits for concurrent MySQL connections and InnoDB parses, globally and
+per host, and a deterministic start offset per asset.
+
+Check intervals of many assets tend to line up; Without limits, all checks
+connect and query at the same moment. Checks which wait for a slot add the
+time to `queue_time` in the `probe` item.
+"""
+import asyncio
+import functools
+import os
+import zlib
+from contextlib import asynccontextmanager
+from libprobe.asset import Asset
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, List, \
+    Optional
+from .executor import PARSE_WORKERS
+from .pool import POOL_MAX_SIZE
+from .timing import phase
+
+
+MAX_CONNECTIONS = int(os.getenv('MAX_CONNECTIONS', 100))
+MAX_HOST_CONNECTIONS = int(os.getenv('MAX_HOST_CONNECTIONS', POOL_MAX_SIZE))
+MAX_PARSES = int(os.getenv('MAX_PARSES', PARSE_WORKERS))
+MAX_HOST_PARSES = int(os.getenv('MAX_HOST_PARSES', 1))
+# Check runs start with an offset between 0 and SCHEDULE_JITTER seconds; the
+# offset is derived from the asset Id, thus the same for every run. The
+# offset is at most 10% of the check interval as it counts for the time-out
+SCHEDULE_JITTER = float(os.getenv('SCHEDULE_JITTER', 5))
+MAX_JITTER_FRACTION = 0.1
+
+CheckFun = Callable[[Asset, dict, dict], Coroutine[Any, Any, dict]]
+
+
+class _Host:
+    __slots__ = ('semaphore', 'users')
+
+    def __init__(self, n: int):
+        self.semaphore = asyncio.Semaphore(n)
+        self.users = 0
+
+
+class Limiter:
+    __slots__ = ('name', '_semaphore', '_max_per_host', '_hosts', 'queued',
+                 'active')
+
+    def __init__(self, name: str, max_global: int, max_per_host: int):
+        self.name = name
+        self._semaphore = asyncio.Semaphore(max_global)
+        self._max_per_host = max_per_host
+        # Only hosts with queued or active slots have an entry
+        self._hosts: Dict[str, _Host] = {}
+        self.queued = 0
+        self.active = 0
+
+    @asynccontextmanager
+    async def slot(self, host: str) -> AsyncIterator[None]:
+        entry = self._hosts.get(host)
+        if entry is None:
+            entry = self._hosts[host] = _Host(self._max_per_host)
+        entry.users += 1
+        self.queued += 1
+        try:
+            with phase('queue'):
+                # Wait for the host first; a check waiting for its host does
+                # not hold one of the global slots
+                await entry.semaphore.acquire()
+                try:
+                    await self._semaphore.acquire()
+                except BaseException:
+                    entry.semaphore.release()
+                    raise
+        except BaseException:
+            self._release_host(host, entry)
+            raise
+        finally:
+            self.queued -= 1
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            entry.semaphore.release()
+            self._release_host(host, entry)
+
+    def _release_host(self, host: str, entry: _Host):
+        entry.users -= 1
+        if entry.users == 0:
+            del self._hosts[host]
+
+
+connections = Limiter('connections', MAX_CONNECTIONS, MAX_HOST_CONNECTIONS)
+parses = Limiter('parses', MAX_PARSES, MAX_HOST_PARSES)
+LIMITERS: List[Limiter] = [connections, parses]
+
+
+def start_offset(asset: Asset, interval: Optional[float] = None) -> float:
+    jitter = SCHEDULE_JITTER
+    if interval:
+        jitter = min(jitter, interval * MAX_JITTER_FRACTION)
+    # crc32 instead of hash(); must not change between probe restarts
+    return zlib.crc32(str(asset.id).encode()) % 1000 / 1000 * jitter
+
+
+def _scheduled(fun: CheckFun) -> CheckFun:
+
+    @functools.wraps(fun)
+    async def wrapper(asset: Asset, asset_config: dict, config: dict) -> dict:
+        if SCHEDULE_JITTER:
+            await asyncio.sleep(
+                start_offset(asset, config.get('_interval')))
+        result = await fun(asset, asset_config, config)
+        for item in result.get('probe', ()):
+            for limiter in LIMITERS:
+                item[f'{limiter.name}_queued'] = limiter.queued
+                item[f'{limiter.name}_active'] = limiter.active
+        return result
+
+    return wrapper
+
+
+def schedule_checks(checks: Dict[str, CheckFun]) -> Dict[str, CheckFun]:
+    return {
+        check_key: _scheduled(fun)
+        for check_key, fun in checks.items()}
@@ -0,0 +1,97 @@
+"""Per-check timing of the queue, connect, query and convert phases, with
+the bytes (and bytes saved by compression) and rows received; Returned by
+the checks as `probe` item.
+
+The timing of the running check is kept in a context variable so the query
+helpers do not need an extra argument; Outside a check nothing is recorded.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+
+PHASES = ('queue', 'connect', 'query', 'convert')
+
+
+class CheckTiming:
+    __slots__ = ('started', 'phases', 'bytes_received', 'bytes_saved', 'rows')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = dict.fromkeys(PHASES, 0.0)
+        self.bytes_received = 0
+        self.bytes_saved = 0
+        self.rows = 0
+
+    def as_item(self) -> Dict[str, Any]:
+        item: Dict[str, Any] = {
+            f'{name}_time': duration
+            for name, duration in self.phases.items()}
+        item['duration'] = time.perf_counter() - self.started
+        item['bytes_received'] = self.bytes_received
+        item['bytes_saved'] = self.bytes_saved
+        item['rows'] = self.rows
+        return item
+
+
+_timing: ContextVar[Optional[CheckTiming]] = \
+    ContextVar('timing', default=None)
+
+
+def start_timing() -> CheckTiming:
+    timing = CheckTiming()
+    _timing.set(timing)
+    return timing
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    timing = _timing.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.phases[name] += time.perf_counter() - start
+
+
+def add_rows(n: int):
+    timing = _timing.get()
+    if timing is not None:
+        timing.rows += n
+
+
+def add_bytes_saved(n: int):
+    timing = _timing.get()
+    if timing is not None:
+        timing.bytes_saved += n
+
+
+def received_bytes() -> int:
+    # Uncompressed bytes received so far by the running check
+    timing = _timing.get()
+    if timing is None:
+        return 0
+    return timing.bytes_received + timing.bytes_saved
+
+
+def count_bytes_received(conn):
+    # aiomysql reads every packet using readexactly() on the stream reader of
+    # the connection; wrap it (once per connection) to count the bytes
+    reader = conn._reader
+    if reader is None or getattr(reader, 'counted', False):
+        return
+    readexactly = reader.readexactly
+
+    async def counting_readexactly(n: int) -> bytes:
+        data = await readexactly(n)
+        timing = _timing.get()
+        if timing is not None:
+            timing.bytes_received += len(data)
+        return data
+
+    reader.readexactly = counting_readexactly
+    reader.counted = True
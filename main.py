@@ -1,14 +1,22 @@
 from libprobe.probe import Probe
+from lib.check.digests import check_digests
 from lib.check.innodb import check_innodb
+from lib.check.locks import check_locks
 from lib.check.mysql import check_mysql
+from lib.check.tables import check_tables
+from lib.profiling import profile_checks
+from lib.scheduler import schedule_checks
 from lib.version import __version__ as version
 
 
 if __name__ == '__main__':
-    checks = {
+    checks = schedule_checks(profile_checks({
+        'digests': check_digests,
         'innodb': check_innodb,
+        'locks': check_locks,
         'mysql': check_mysql,
-    }
+        'tables': check_tables,
+    }))
 
     probe = Probe("mysql", version, checks)
 
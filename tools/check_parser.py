@@ -0,0 +1,87 @@
+"""Check the InnoDB status parser against the dumps in tools/innodb_status.
+
+Each dump (MySQL 5.5, 5.7 and 8.0, MariaDB, Percona Server and a file with
+the format variants of single lines) has a JSON file next to it with the
+expected result of get_stats_from_innodb_status. Each dump is parsed as is
+and with at most one fully parsed transaction (INNODB_MAX_TRANSACTIONS),
+which must give the same counts.
+
+Usage (from the repository root):
+
+    python -m tools.check_parser
+
+Use --update to write the current results as the expected results, after
+checking the changes with git diff.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from typing import Any, Dict, List
+from lib.check import innodb
+from lib.check.innodb import get_stats_from_innodb_status
+
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'innodb_status')
+
+
+def _parse(text: str, max_transactions: int) -> Dict[str, Any]:
+    innodb.INNODB_MAX_TRANSACTIONS = max_transactions
+    # Through JSON, as the expected results are
+    return json.loads(json.dumps(
+        get_stats_from_innodb_status(text, buffer_pools=True),
+        sort_keys=True))
+
+
+def _diff(expected: Dict[str, Any], result: Dict[str, Any]) -> List[str]:
+    return [
+        f'{key}: expected {expected.get(key)!r}, got {result.get(key)!r}'
+        for key in sorted(set(expected) | set(result))
+        if expected.get(key) != result.get(key)]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(__doc__ or '').split('\n')[0])
+    parser.add_argument(
+        '--update', action='store_true',
+        help='write the current results as the expected results')
+    args = parser.parse_args()
+    # Lines which can not be parsed are part of the corpus
+    logging.disable(logging.WARNING)
+
+    failed = 0
+    names = sorted(
+        fn[:-4] for fn in os.listdir(CORPUS) if fn.endswith('.txt'))
+    for name in names:
+        with open(os.path.join(CORPUS, f'{name}.txt')) as fp:
+            text = fp.read()
+        result = _parse(text, 0)
+        fn = os.path.join(CORPUS, f'{name}.json')
+        if args.update:
+            with open(fn, 'w') as fp:
+                json.dump(result, fp, indent=2, sort_keys=True)
+                fp.write('\n')
+            print(f'{name}: updated')
+            continue
+
+        with open(fn) as fp:
+            errors = _diff(json.load(fp), result)
+        capped = _parse(text, 1)
+        capped['transactions_inspected'] = result['transactions_inspected']
+        errors.extend(
+            f'with INNODB_MAX_TRANSACTIONS=1, {error}'
+            for error in _diff(result, capped))
+        if errors:
+            failed += 1
+            print(f'{name}: FAILED')
+            for error in errors:
+                print(f'    {error}')
+        else:
+            print(f'{name}: ok ({len(result)} metrics)')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,522 @@
+"""Fake MySQL server for load testing the probe.
+
+Speaks enough of the MySQL client/server protocol for the `mysql`, `innodb`
+and `locks` checks: the handshake (any credentials are accepted), COM_PING,
+COM_QUIT and COM_QUERY with multiple statements, optionally compressed.
+Status and variables are synthetic (counters grow with the uptime of the
+fake server); the InnoDB status is synthetic with a configurable size, or
+replayed from a file.
+
+Usage (from the repository root):
+
+    python -m tools.fake_mysql --port 3306 --latency 5 --innodb-size 65536
+
+The server listens on all addresses, thus also on every 127.x.y.z address;
+use different loopback addresses to simulate different hosts. With --socket
+the server listens on a Unix socket instead.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import re
+import struct
+import time
+import zlib
+from typing import Dict, List, Optional, Sequence, Tuple
+from lib.check.innodb import INNODB_METRICS_VARS, INNODB_STATUS_VARS
+from lib.check.mysql import STATUS_VARS, VARIABLES_VARS
+
+
+SERVER_VERSION = '8.0.36-fake'
+
+CLIENT_LONG_PASSWORD = 1
+CLIENT_FOUND_ROWS = 1 << 1
+CLIENT_LONG_FLAG = 1 << 2
+CLIENT_CONNECT_WITH_DB = 1 << 3
+CLIENT_COMPRESS = 1 << 5
+CLIENT_PROTOCOL_41 = 1 << 9
+CLIENT_TRANSACTIONS = 1 << 13
+CLIENT_SECURE_CONNECTION = 1 << 15
+CLIENT_MULTI_STATEMENTS = 1 << 16
+CLIENT_MULTI_RESULTS = 1 << 17
+CLIENT_PLUGIN_AUTH = 1 << 19
+CAPABILITIES = (
+    CLIENT_LONG_PASSWORD | CLIENT_FOUND_ROWS | CLIENT_LONG_FLAG |
+    CLIENT_CONNECT_WITH_DB | CLIENT_COMPRESS | CLIENT_PROTOCOL_41 |
+    CLIENT_TRANSACTIONS | CLIENT_SECURE_CONNECTION |
+    CLIENT_MULTI_STATEMENTS | CLIENT_MULTI_RESULTS | CLIENT_PLUGIN_AUTH)
+
+SERVER_STATUS_AUTOCOMMIT = 0x0002
+SERVER_MORE_RESULTS_EXISTS = 0x0008
+
+COM_QUIT = 0x01
+COM_INIT_DB = 0x02
+COM_QUERY = 0x03
+COM_PING = 0x0e
+
+TYPE_LONGLONG = 8
+TYPE_VAR_STRING = 253
+CHARSET_UTF8 = 33
+
+MAX_PACKET = 0xffffff
+MIN_COMPRESS_LENGTH = 50
+
+Rows = List[Sequence[Optional[object]]]
+Result = Tuple[Sequence[Tuple[str, int]], Rows]
+
+_names = re.compile(r"'([^']*)'")
+
+
+def lenenc_int(n: int) -> bytes:
+    if n < 251:
+        return bytes((n,))
+    if n < 1 << 16:
+        return b'\xfc' + struct.pack('<H', n)
+    if n < 1 << 24:
+        return b'\xfd' + struct.pack('<I', n)[:3]
+    return b'\xfe' + struct.pack('<Q', n)
+
+
+def lenenc_str(s: bytes) -> bytes:
+    return lenenc_int(len(s)) + s
+
+
+class Payloads:
+    """Synthetic server state; counters grow with the uptime."""
+
+    def __init__(
+            self,
+            innodb_size: int,
+            innodb_file: Optional[str],
+            lock_waits: int = 0):
+        self.started = time.monotonic()
+        rnd = random.Random(0)
+        self.rates = {name: rnd.uniform(0.1, 100.0) for name in STATUS_VARS}
+        self.innodb_rates = {
+            name: rnd.uniform(0.1, 100.0) for name in INNODB_STATUS_VARS}
+        self.variables: Dict[str, str] = {
+            name: '1' if var_type in (int, float) else 'ON'
+            for name, var_type in VARIABLES_VARS.items()}
+        self.variables.update({
+            'version': SERVER_VERSION,
+            'version_comment': 'Fake MySQL Server',
+            'performance_schema': 'ON',
+            'innodb_page_size': '16384',
+        })
+        self.innodb_size = innodb_size
+        self.innodb_text = None
+        if innodb_file:
+            with open(innodb_file) as fp:
+                self.innodb_text = fp.read()
+        # Transaction n (thread n) waits on transaction n // 2, thus a tree
+        # with transaction 1 as root blocker
+        self.lock_waits: Rows = [
+            (trx, trx // 2) for trx in range(2, lock_waits + 2)]
+        self.trx: Rows = [
+            (trx, trx, 'LOCK WAIT' if trx > 1 else 'RUNNING', 2, 100,
+             60 - trx % 60 if trx > 1 else None)
+            for trx in range(1, lock_waits + 2)] if lock_waits else []
+
+    def uptime(self) -> int:
+        return int(time.monotonic() - self.started) + 1
+
+    def status(self) -> Dict[str, str]:
+        uptime = self.uptime()
+        status = {
+            name: str(int(rate * uptime))
+            if STATUS_VARS[name] is int else 'ON'
+            for name, rate in self.rates.items()}
+        status.update(
+            (name, str(int(rate * uptime)))
+            for name, rate in self.innodb_rates.items())
+        status.update({
+            'Uptime': str(uptime),
+            'Threads_running': '2',
+            'Innodb_page_size': '16384',
+            'Innodb_buffer_pool_pages_total': '8192',
+            'Innodb_buffer_pool_pages_free': '7000',
+            'Innodb_buffer_pool_pages_data': '1190',
+            'Innodb_buffer_pool_pages_dirty': '12',
+        })
+        return status
+
+    def innodb_metrics(self) -> Rows:
+        uptime = self.uptime()
+        return [(name, uptime * 10) for name in INNODB_METRICS_VARS]
+
+    def innodb_status(self) -> str:
+        if self.innodb_text is not None:
+            return self.innodb_text
+        return innodb_status(self.uptime(), self.innodb_size)
+
+
+_TRANSACTION = """\
+---TRANSACTION {trx}, ACTIVE 3 sec starting index read
+mysql tables in use 1, locked 1
+LOCK WAIT 2 lock struct(s), heap size 1136, 1 row lock(s)
+MySQL thread id {trx}, OS thread handle 1400, query id 99 localhost root
+update t set a=1 where id={trx}
+"""
+
+
+def _buffer_pools(uptime: int, n: int = 4) -> str:
+    # Uneven instances; the last one holds most dirty pages
+    return ''.join(f"""---BUFFER POOL {i}
+Buffer pool size   {8192 // n}
+Free buffers       {7000 // n}
+Database pages     {1190 // n}
+Old database pages 0
+Modified db pages  {12 if i == n - 1 else 0}
+Pending reads      0
+Pending writes: LRU 0, flush list 0, single page 0
+Pages made young 0, not young 0
+0.00 youngs/s, 0.00 non-youngs/s
+Pages read {uptime * 10 // n}, created {uptime * 2 // n}, \
+written {uptime * 4 // n}
+0.00 reads/s, 0.00 creates/s, 0.00 writes/s
+Buffer pool hit rate {1000 - i} / 1000, young-making rate 0 / 1000 not 0 / 1000
+LRU len: {1190 // n}, unzip_LRU len: 0
+I/O sum[0]:cur[0], unzip sum[0]:cur[0]
+""" for i in range(n))
+
+
+def innodb_status(uptime: int, size: int) -> str:
+    head = f"""
+=====================================
+2024-05-01 10:00:00 140000000000000 INNODB MONITOR OUTPUT
+=====================================
+Per second averages calculated from the last 10 seconds
+----------
+SEMAPHORES
+----------
+OS WAIT ARRAY INFO: reservation count {uptime}
+RW-shared spins {uptime * 60}, rounds {uptime * 800}, OS waits {uptime * 24}
+RW-excl spins {uptime * 6}, rounds {uptime * 80}, OS waits {uptime * 2}
+------------
+TRANSACTIONS
+------------
+Trx id counter {uptime * 1000}
+History list length 132
+LIST OF TRANSACTIONS FOR EACH SESSION:
+"""
+    tail = f"""--------
+FILE I/O
+--------
+Pending normal aio reads: [0, 0, 0, 0] , aio writes: [0, 0, 0, 0] ,
+ ibuf aio reads:, log i/o's:, sync i/o's:
+Pending flushes (fsync) log: 0; buffer pool: 0
+{uptime * 87} OS file reads, {uptime * 156} OS file writes, \
+{uptime * 9} OS fsyncs
+-------------------------------------
+INSERT BUFFER AND ADAPTIVE HASH INDEX
+-------------------------------------
+Ibuf: size 1, free list len 4634, seg size 4636, {uptime} merges
+merged operations:
+ insert {uptime * 5}, delete mark {uptime * 3}, delete {uptime}
+Hash table size 4425293, node heap has 72964 buffer(s)
+---
+LOG
+---
+Log sequence number          {uptime * 1000 + 600}
+Log flushed up to            {uptime * 1000 + 500}
+Last checkpoint at           {uptime * 1000}
+0 pending log flushes, 0 pending chkp writes
+{uptime * 34} log i/o's done, 17.44 log i/o's/second
+----------------------
+BUFFER POOL AND MEMORY
+----------------------
+Total large memory allocated 137035776
+Buffer pool size   8192
+Free buffers       7000
+Database pages     1190
+Modified db pages  12
+Pages read {uptime * 10}, created {uptime * 2}, written {uptime * 4}
+----------------------
+INDIVIDUAL BUFFER POOL INFO
+----------------------
+{_buffer_pools(uptime)}--------------
+ROW OPERATIONS
+--------------
+0 queries inside InnoDB, 0 queries in queue
+1 read views open inside InnoDB
+Number of rows inserted {uptime * 506}, updated {uptime * 664}, \
+deleted {uptime * 206}, read {uptime * 4545}
+----------------------------
+END OF INNODB MONITOR OUTPUT
+============================
+"""
+    parts = [head]
+    n = len(head) + len(tail)
+    trx = 1000
+    while n < size:
+        trx += 1
+        part = _TRANSACTION.format(trx=trx)
+        parts.append(part)
+        n += len(part)
+    parts.append(tail)
+    return ''.join(parts)
+
+
+class Handler:
+    def __init__(
+            self,
+            payloads: Payloads,
+            latency: float,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            thread_id: int):
+        self.payloads = payloads
+        self.latency = latency
+        self.reader = reader
+        self.writer = writer
+        self.thread_id = thread_id
+        self.seq = 0
+        # Compressed protocol, with its own sequence Id; packets are
+        # collected in `out` and compressed on flush()
+        self.compress = False
+        self.compressed_seq = 0
+        self.out = bytearray()
+        self.buf = bytearray()
+
+    def write_packet(self, payload: bytes):
+        # Payloads of 16MB or more are split; a payload of exactly a multiple
+        # of MAX_PACKET is followed by an empty packet
+        write = self.out.extend if self.compress else self.writer.write
+        while True:
+            chunk, payload = payload[:MAX_PACKET], payload[MAX_PACKET:]
+            write(struct.pack('<I', len(chunk))[:3] + bytes((self.seq,)))
+            write(chunk)
+            self.seq = (self.seq + 1) & 0xff
+            if len(chunk) < MAX_PACKET:
+                break
+
+    def flush(self):
+        out, self.out = self.out, bytearray()
+        for pos in range(0, len(out), MAX_PACKET):
+            chunk = bytes(out[pos:pos + MAX_PACKET])
+            if len(chunk) < MIN_COMPRESS_LENGTH:
+                payload, length = chunk, 0
+            else:
+                payload, length = zlib.compress(chunk), len(chunk)
+            self.writer.write(
+                struct.pack('<I', len(payload))[:3] +
+                bytes((self.compressed_seq,)) +
+                struct.pack('<I', length)[:3] + payload)
+            self.compressed_seq = (self.compressed_seq + 1) & 0xff
+
+    async def read(self, n: int) -> bytes:
+        if not self.compress:
+            return await self.reader.readexactly(n)
+        while len(self.buf) < n:
+            header = await self.reader.readexactly(7)
+            payload = await self.reader.readexactly(
+                int.from_bytes(header[:3], 'little'))
+            if int.from_bytes(header[4:7], 'little'):
+                payload = zlib.decompress(payload)
+            self.buf += payload
+            self.compressed_seq = (header[3] + 1) & 0xff
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    async def read_packet(self) -> bytes:
+        header = await self.read(4)
+        length = int.from_bytes(header[:3], 'little')
+        self.seq = (header[3] + 1) & 0xff
+        return await self.read(length)
+
+    def ok(self, status: int = SERVER_STATUS_AUTOCOMMIT):
+        self.write_packet(
+            b'\x00' + lenenc_int(0) + lenenc_int(0) +
+            struct.pack('<HH', status, 0))
+
+    def eof(self, status: int = SERVER_STATUS_AUTOCOMMIT):
+        self.write_packet(b'\xfe' + struct.pack('<HH', 0, status))
+
+    def error(self, code: int, state: str, msg: str):
+        self.write_packet(
+            b'\xff' + struct.pack('<H', code) + b'#' + state.encode() +
+            msg.encode())
+
+    def result(self, result: Result, status: int):
+        columns, rows = result
+        self.write_packet(lenenc_int(len(columns)))
+        for name, type_code in columns:
+            self.write_packet(
+                lenenc_str(b'def') + lenenc_str(b'') + lenenc_str(b'') +
+                lenenc_str(b'') + lenenc_str(name.encode()) +
+                lenenc_str(name.encode()) + b'\x0c' +
+                struct.pack('<HIBHB', CHARSET_UTF8, 1024, type_code, 0, 0) +
+                b'\x00\x00')
+        self.eof()
+        for row in rows:
+            self.write_packet(b''.join(
+                b'\xfb' if value is None else lenenc_str(str(value).encode())
+                for value in row))
+        self.eof(status)
+
+    def handshake(self):
+        salt = bytes(random.randrange(1, 128) for _ in range(20))
+        self.write_packet(
+            b'\x0a' + SERVER_VERSION.encode() + b'\x00' +
+            struct.pack('<I', self.thread_id) + salt[:8] + b'\x00' +
+            struct.pack('<HBHH', CAPABILITIES & 0xffff, CHARSET_UTF8,
+                        SERVER_STATUS_AUTOCOMMIT, CAPABILITIES >> 16) +
+            bytes((21,)) + b'\x00' * 10 + salt[8:] + b'\x00' +
+            b'mysql_native_password\x00')
+
+    def statement(self, sql: str) -> Optional[Result]:
+        """Returns a result set, or None for an OK packet; Raises KeyError
+        for unknown statements."""
+        if sql.startswith(('SET ', 'KILL ')):
+            return None
+        if 'data_lock_waits' in sql or 'INNODB_LOCK_WAITS' in sql:
+            return (('waiting', TYPE_LONGLONG), ('blocking', TYPE_LONGLONG)), \
+                self.payloads.lock_waits
+        if 'INNODB_TRX' in sql and 'trx_query' in sql:
+            return (('trx_id', TYPE_LONGLONG),
+                    ('trx_query', TYPE_VAR_STRING)), \
+                [(1, 'update t set a = 1 where id < 1000')]
+        if 'INNODB_TRX' in sql:
+            return (('trx_id', TYPE_LONGLONG),
+                    ('trx_mysql_thread_id', TYPE_LONGLONG),
+                    ('trx_state', TYPE_VAR_STRING),
+                    ('trx_rows_locked', TYPE_LONGLONG),
+                    ('trx_age', TYPE_LONGLONG),
+                    ('wait_age', TYPE_LONGLONG)), self.payloads.trx
+        if 'INNODB STATUS' in sql:
+            return (('Type', TYPE_VAR_STRING), ('Name', TYPE_VAR_STRING),
+                    ('Status', TYPE_VAR_STRING)), \
+                [('InnoDB', '', self.payloads.innodb_status())]
+        if 'information_schema.ENGINES' in sql:
+            return (('engine', TYPE_VAR_STRING),), [('InnoDB',)]
+        if 'INNODB_METRICS' in sql:
+            return (('NAME', TYPE_VAR_STRING), ('COUNT', TYPE_LONGLONG)), \
+                self.payloads.innodb_metrics()
+        if 'global_status' in sql or 'STATUS' in sql:
+            return self.variables(sql, self.payloads.status())
+        if 'global_variables' in sql or 'VARIABLES' in sql:
+            return self.variables(sql, self.payloads.variables)
+        raise KeyError(sql)
+
+    @staticmethod
+    def variables(sql: str, values: Dict[str, str]) -> Result:
+        if 'FROM performance_schema.' in sql:
+            columns = (('VARIABLE_NAME', TYPE_VAR_STRING),
+                       ('VARIABLE_VALUE', TYPE_VAR_STRING))
+        else:
+            columns = (('Variable_name', TYPE_VAR_STRING),
+                       ('Value', TYPE_VAR_STRING))
+        if ' IN (' in sql or ' LIKE ' in sql:
+            names = _names.findall(sql)
+            rows: Rows = [
+                (name, values[name]) for name in names if name in values]
+        else:
+            rows = list(values.items())
+        return columns, rows
+
+    async def query(self, sql: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        statements = [s.strip() for s in sql.split(';') if s.strip()]
+        for idx, statement in enumerate(statements):
+            status = SERVER_STATUS_AUTOCOMMIT
+            if idx < len(statements) - 1:
+                status |= SERVER_MORE_RESULTS_EXISTS
+            try:
+                result = self.statement(statement)
+            except KeyError:
+                # The server stops at the first failing statement
+                self.error(1146, '42S02', f'unsupported: {statement[:60]}')
+                return
+            if result is None:
+                self.ok(status)
+            else:
+                self.result(result, status)
+
+    async def run(self):
+        self.handshake()
+        # Handshake response; only the capabilities are used
+        response = await self.read_packet()
+        self.ok()
+        self.compress = bool(
+            struct.unpack('<I', response[:4])[0] & CLIENT_COMPRESS)
+        while True:
+            packet = await self.read_packet()
+            command = packet[0]
+            if command == COM_QUIT:
+                break
+            elif command == COM_QUERY:
+                await self.query(packet[1:].decode())
+            elif command in (COM_PING, COM_INIT_DB):
+                self.ok()
+            else:
+                self.error(1047, '08S01', 'unknown command')
+            if self.compress:
+                self.flush()
+            await self.writer.drain()
+
+
+async def serve(
+        host: str,
+        port: int,
+        latency: float,
+        innodb_size: int,
+        innodb_file: Optional[str],
+        unix_socket: Optional[str] = None,
+        lock_waits: int = 0) -> asyncio.Server:
+    payloads = Payloads(innodb_size, innodb_file, lock_waits)
+    thread_ids = iter(range(1, 1 << 32))
+
+    async def on_connect(
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter):
+        handler = Handler(payloads, latency, reader, writer, next(thread_ids))
+        try:
+            await handler.run()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    if unix_socket:
+        return await asyncio.start_unix_server(
+            on_connect, unix_socket, backlog=4096)
+    return await asyncio.start_server(on_connect, host, port, backlog=4096)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(__doc__ or '').split('\n')[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--socket', help='listen on this Unix socket')
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='latency per query in milliseconds')
+    parser.add_argument(
+        '--innodb-size', type=int, default=8192,
+        help='size of the synthetic InnoDB status in bytes')
+    parser.add_argument(
+        '--innodb-file',
+        help='replay the InnoDB status from this file')
+    parser.add_argument(
+        '--lock-waits', type=int, default=0,
+        help='number of transactions waiting for a lock')
+    args = parser.parse_args()
+
+    async def run():
+        server = await serve(
+            args.host, args.port, args.latency / 1000, args.innodb_size,
+            args.innodb_file, args.socket, args.lock_waits)
+        logging.warning(
+            f'fake MySQL server on {args.socket or args.host}:{args.port}')
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
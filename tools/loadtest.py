@@ -0,0 +1,258 @@
+"""Load test the probe against the fake MySQL server.
+
+Runs the checks for many simulated assets, each on its own loopback address
+(127.x.y.z) so the per-host pools and limits behave as with real servers,
+and reports throughput, check latency, bytes received per check, CPU time
+and the RSS of the probe. The fake server runs in a separate process.
+
+Usage (from the repository root):
+
+    python -m tools.loadtest --assets 2000 --interval 30 --duration 300
+
+Settings of the probe (POOL_MAX_SIZE, MAX_CONNECTIONS, PARSE_EXECUTOR, ...)
+are read from the environment as usual. Use --compress or --socket to compare
+the transports. Use --json to get the report as a
+single JSON line, for comparing runs.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import resource
+import time
+from collections import Counter
+from libprobe.asset import Asset
+from typing import Dict, List, Optional
+from lib.check.innodb import check_innodb
+from lib.check.mysql import check_mysql
+from lib.profiling import profile_checks
+from lib.scheduler import schedule_checks
+from .fake_mysql import serve
+
+
+CHECKS = {
+    'innodb': check_innodb,
+    'mysql': check_mysql,
+}
+
+
+def _raise_nofile():
+    # Every asset uses up to POOL_MAX_SIZE connections
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _run_server(
+        port: int,
+        latency: float,
+        innodb_size: int,
+        unix_socket: Optional[str]):
+    _raise_nofile()
+
+    async def run():
+        server = await serve(
+            '0.0.0.0', port, latency, innodb_size, None, unix_socket)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+async def _wait_for_server(
+        port: int,
+        unix_socket: Optional[str],
+        timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if unix_socket:
+                _, writer = await asyncio.open_unix_connection(unix_socket)
+            else:
+                _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
+def _address(idx: int) -> str:
+    n = idx + 2  # skip 127.0.0.0 and 127.0.0.1
+    return f'127.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}'
+
+
+def _rss() -> int:
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * resource.getpagesize()
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * pct), len(values) - 1)]
+
+
+class Stats:
+    def __init__(self):
+        self.latency: List[float] = []
+        self.duration: List[float] = []
+        self.errors: Counter = Counter()
+        self.bytes_received: Counter = Counter()
+        self.bytes_saved: Counter = Counter()
+        self.runs: Counter = Counter()
+        self.completed = 0
+
+
+async def _run_check(
+        check_key: str,
+        fun,
+        asset: Asset,
+        config: dict,
+        interval: float,
+        stop: float,
+        warmup: float,
+        stats: Stats):
+    asset_config = {'username': 'probe', 'password': 'secret'}
+    next_run = time.monotonic()
+    while next_run < stop:
+        start = time.monotonic()
+        try:
+            # Same time-out as libprobe; 80% of the interval
+            result = await asyncio.wait_for(
+                fun(asset, asset_config, config), timeout=interval * 0.8)
+        except Exception as e:
+            if start >= warmup:
+                stats.errors[f'{check_key}: {type(e).__name__}'] += 1
+        else:
+            if start >= warmup:
+                stats.completed += 1
+                stats.latency.append(time.monotonic() - start)
+                for item in result.get('probe', ()):
+                    stats.duration.append(item['duration'])
+                    stats.bytes_received[check_key] += item['bytes_received']
+                    stats.bytes_saved[check_key] += item['bytes_saved']
+                    stats.runs[check_key] += 1
+        next_run += interval
+        await asyncio.sleep(max(next_run - time.monotonic(), 0.0))
+
+
+async def _main(args) -> Dict[str, object]:
+    ctx = multiprocessing.get_context('spawn')
+    server = ctx.Process(
+        target=_run_server,
+        args=(args.port, args.latency / 1000, args.innodb_size, args.socket),
+        daemon=True)
+    server.start()
+    try:
+        await _wait_for_server(args.port, args.socket)
+        checks = schedule_checks(profile_checks({
+            check_key: CHECKS[check_key]
+            for check_key in args.checks.split(',')}))
+
+        stats = Stats()
+        start = time.monotonic()
+        warmup = start + args.warmup
+        stop = start + args.duration
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        tasks = []
+        for idx in range(args.assets):
+            config = {
+                'address': _address(idx),
+                'port': args.port,
+                '_interval': int(args.interval),
+            }
+            if args.socket:
+                config['socket'] = args.socket
+            if args.compress:
+                config['compress'] = \
+                    'auto' if args.compress == 'auto' else True
+            for check_key, fun in checks.items():
+                asset = Asset(idx + 1, f'asset{idx}', check_key)
+                tasks.append(asyncio.create_task(_run_check(
+                    check_key, fun, asset, config, args.interval, stop,
+                    warmup, stats)))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - max(warmup, start)
+        cpu = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        server.terminate()
+        server.join()
+
+    cpu_time = cpu.ru_utime + cpu.ru_stime - usage.ru_utime - usage.ru_stime
+    return {
+        'assets': args.assets,
+        'checks': args.checks,
+        'interval': args.interval,
+        'completed': stats.completed,
+        'errors': dict(stats.errors),
+        'throughput': stats.completed / elapsed if elapsed > 0 else 0.0,
+        'latency_p50': _percentile(stats.latency, 0.50),
+        'latency_p99': _percentile(stats.latency, 0.99),
+        'duration_p50': _percentile(stats.duration, 0.50),
+        'duration_p99': _percentile(stats.duration, 0.99),
+        # Average per check run
+        'bytes_received': {
+            key: stats.bytes_received[key] // n
+            for key, n in stats.runs.items()},
+        'bytes_saved': {
+            key: stats.bytes_saved[key] // n
+            for key, n in stats.runs.items()},
+        'cpu_time': cpu_time,
+        'rss': _rss(),
+        'max_rss': cpu.ru_maxrss * 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(__doc__ or '').split('\n')[0])
+    parser.add_argument('--assets', type=int, default=100)
+    parser.add_argument(
+        '--checks', default='mysql,innodb',
+        help='comma separated checks to run')
+    parser.add_argument(
+        '--interval', type=float, default=10.0,
+        help='check interval in seconds')
+    parser.add_argument(
+        '--duration', type=float, default=60.0,
+        help='test duration in seconds')
+    parser.add_argument(
+        '--warmup', type=float, default=None,
+        help='seconds excluded from the report (default one interval)')
+    parser.add_argument('--port', type=int, default=13306)
+    parser.add_argument(
+        '--socket', help='connect using this Unix socket instead of TCP')
+    parser.add_argument(
+        '--compress', choices=('on', 'auto'),
+        help='use the compressed protocol')
+    parser.add_argument(
+        '--latency', type=float, default=1.0,
+        help='latency per query of the fake server in milliseconds')
+    parser.add_argument(
+        '--innodb-size', type=int, default=8192,
+        help='size of the InnoDB status in bytes')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    if args.warmup is None:
+        args.warmup = args.interval
+
+    logging.basicConfig(level=logging.ERROR)
+    _raise_nofile()
+    report = asyncio.run(_main(args))
+
+    if args.json:
+        print(json.dumps(report))
+        return
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f'{value:.4f}'
+        print(f'{key:<14} {value}')
+
+
+if __name__ == '__main__':
+    main()